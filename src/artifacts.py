@@ -0,0 +1,265 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Content-addressed cache for the products of conversion recipes.
+
+The products of a node only depending on its sources and on its
+command line (see rubber.depend.Node.signature) are stored under a key
+computed from these. When another build, maybe in another checkout,
+needs the same products from identical sources, they are restored from
+the cache instead of running the external tool again.
+
+The storage itself is delegated to a backend, which only needs to map
+keys to byte strings. A local directory with a size bound and a simple
+HTTP server (GET and PUT on URL/KEY) are supported.
+"""
+
+import hashlib
+import io
+import logging
+msg = logging.getLogger (__name__)
+import os
+import tarfile
+import tempfile
+import threading
+import time
+import urllib.error
+import urllib.request
+from rubber.util import _
+import rubber.contents
+import rubber.util
+
+class Backend:
+    """
+    The interface of storage backends. Both methods may be called
+    concurrently from several threads or processes.
+    """
+    def get (self, key):
+        """Return the data stored for key, or None."""
+        return None
+
+    def put (self, key, data):
+        """Store the data for key, or silently do nothing."""
+
+class DirectoryBackend (Backend):
+    """
+    Store each entry in a file, evicting the least recently used ones
+    when the total size exceeds a limit (in bytes). The total size is
+    only measured again when the size of the entries stored since the
+    last measure may exceed the limit, and eviction then goes below
+    the limit by a margin, so that the directory is not scanned on each
+    entry. Errors are reported as cache misses.
+    """
+    # Eviction keeps at most this fraction of the limit.
+    margin = 0.9
+    # Temporary files older than this (in seconds) are left over by
+    # interrupted processes, younger ones may still be written.
+    stale = 24 * 3600
+
+    def __init__ (self, root, max_size):
+        self.root = os.path.abspath (root)
+        self.max_size = max_size
+        self.lock = threading.Lock ()
+        # The total size at the last measure plus the size of the
+        # entries stored since, or None before the first measure.
+        self.size = None
+
+    def path (self, key):
+        return os.path.join (self.root, key [:2], key)
+
+    def get (self, key):
+        path = self.path (key)
+        try:
+            with open (path, 'rb') as f:
+                data = f.read ()
+        except FileNotFoundError:
+            return None
+        except OSError as e:
+            msg.debug (_("artifact cache: cannot get %s: %s"), key, e)
+            return None
+        # Record the access for the eviction policy.
+        try:
+            os.utime (path)
+        except OSError:
+            pass
+        return data
+
+    def put (self, key, data):
+        path = self.path (key)
+        directory = os.path.dirname (path)
+        try:
+            os.makedirs (directory, exist_ok=True)
+            with tempfile.NamedTemporaryFile (dir=directory, prefix='.' + key,
+                                              delete=False) as f:
+                try:
+                    f.write (data)
+                except OSError:
+                    os.remove (f.name)
+                    raise
+            os.replace (f.name, path)
+        except OSError as e:
+            msg.debug (_("artifact cache: cannot put %s: %s"), key, e)
+            return
+        with self.lock:
+            if self.size is not None:
+                self.size += len (data)
+            if self.size is None or self.size > self.max_size:
+                self.evict ()
+
+    def evict (self):
+        """
+        Measure the total size and remove the least recently used
+        entries above the limit. The lock must be held.
+        """
+        entries = []
+        total = 0
+        now = time.time ()
+        try:
+            directories = list (os.scandir (self.root))
+        except OSError as e:
+            msg.debug (_("artifact cache: cannot scan %s: %s"), self.root, e)
+            return
+        for directory in directories:
+            if not directory.is_dir ():
+                continue
+            try:
+                files = list (os.scandir (directory.path))
+            except OSError:
+                continue
+            for entry in files:
+                try:
+                    st = entry.stat ()
+                except OSError:
+                    continue
+                mtime = st.st_mtime_ns
+                if entry.name.startswith ('.'):
+                    # Another process may be writing this file.
+                    if now - st.st_mtime < self.stale:
+                        continue
+                    mtime = 0
+                entries.append ((mtime, st.st_size, entry.path))
+                total += st.st_size
+        if total > self.max_size:
+            entries.sort ()
+            for mtime, size, path in entries:
+                if total <= self.max_size * self.margin:
+                    break
+                msg.debug (_("artifact cache: evicting %s"), path)
+                try:
+                    os.remove (path)
+                except OSError:
+                    continue
+                total -= size
+        self.size = total
+
+class HTTPBackend (Backend):
+    """
+    Store entries on a server answering GET and PUT requests on
+    URL/KEY. Eviction is left to the server. Network errors are
+    reported as cache misses.
+    """
+    def __init__ (self, url):
+        self.url = url.rstrip ('/') + '/'
+
+    def get (self, key):
+        try:
+            with urllib.request.urlopen (self.url + key) as response:
+                return response.read ()
+        except (urllib.error.URLError, OSError) as e:
+            msg.debug (_("artifact cache: cannot get %s: %s"), key, e)
+            return None
+
+    def put (self, key, data):
+        request = urllib.request.Request (self.url + key, data=data,
+                                          method='PUT')
+        try:
+            urllib.request.urlopen (request).close ()
+        except (urllib.error.URLError, OSError) as e:
+            msg.debug (_("artifact cache: cannot put %s: %s"), key, e)
+
+def default_location ():
+    """The directory used when no location is given."""
+    return os.path.join (rubber.util.cache_directory (), 'artifacts')
+
+def open_store (location, max_size):
+    """
+    Create a store from a command line argument: a URL for the HTTP
+    backend, or a directory.
+    """
+    if location.startswith (('http://', 'https://')):
+        return Store (HTTPBackend (location))
+    return Store (DirectoryBackend (location, max_size))
+
+class Store:
+    """
+    Archive and restore the products of nodes through a backend.
+    """
+    def __init__ (self, backend):
+        self.backend = backend
+
+    def key (self, node, snapshots, products):
+        """
+        Compute the key for the given products of node, made from
+        sources with the given snapshots.
+        """
+        h = hashlib.sha256 ()
+        h.update (type (node).__name__.encode ())
+        for word in node.signature ():
+            h.update (b'\0' + word.encode ())
+        h.update (b'\0\0')
+        for product in products:
+            h.update (product.encode () + b'\0')
+        for source, snapshot in zip (node.sources, snapshots):
+            h.update (b'\0' + source.encode () + b'\0')
+            h.update (rubber.contents.cs2str (snapshot).encode ())
+        return h.hexdigest ()
+
+    def restore (self, key, products):
+        """
+        Extract the products stored under key. Return False if the
+        entry is missing or does not contain all products.
+        """
+        data = self.backend.get (key)
+        if data is None:
+            return False
+        try:
+            with tarfile.open (fileobj=io.BytesIO (data)) as archive:
+                members = archive.getmembers ()
+                if set (m.name for m in members) \
+                   != set (str (i) for i in range (len (products))):
+                    msg.debug (_("artifact cache: %s does not match"), key)
+                    return False
+                for member in members:
+                    self.extract (archive, member, products [int (member.name)])
+        except (tarfile.TarError, OSError) as e:
+            msg.warning (_("artifact cache: cannot restore %s: %s"), key, e)
+            return False
+        return True
+
+    def extract (self, archive, member, path):
+        # Entries may come from a shared server, and are not trusted to
+        # only contain plain files with ordinary permissions.
+        if not member.isfile ():
+            raise tarfile.TarError (_("%s is not a regular file") % member.name)
+        directory = os.path.dirname (path) or '.'
+        with tempfile.NamedTemporaryFile (dir=directory, delete=False,
+                prefix='.' + os.path.basename (path)) as f:
+            try:
+                f.write (archive.extractfile (member).read ())
+                os.chmod (f.name, member.mode & 0o777)
+            except:
+                os.remove (f.name)
+                raise
+        os.replace (f.name, path)
+
+    def save (self, key, products):
+        """Store the products under key."""
+        buf = io.BytesIO ()
+        try:
+            with tarfile.open (fileobj=buf, mode='w') as archive:
+                for i, path in enumerate (products):
+                    archive.add (path, arcname=str (i), recursive=False)
+        except (tarfile.TarError, OSError) as e:
+            msg.warning (_("artifact cache: cannot save %s: %s"), key, e)
+            return
+        self.backend.put (key, buf.getvalue ())
@@ -10,19 +10,112 @@ from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
 import rubber.util
+import rubber.contents
 import rubber.depend
+import rubber.trace
+import hashlib
 import os
 import re
+import shutil
 import subprocess
+import tempfile
+import threading
+
+# Fingerprints of the parts of .aux and .bcf files that BibTeX and Biber
+# actually read. LaTeX rewrites these files during each compilation, but
+# the bibliography only needs to be rebuilt when a new entry is cited or
+# when the databases, style or options change.
+
+re_bibtex_aux = re.compile (rb'\\(citation|bibdata|bibstyle|@input)\{([^}]*)\}')
+
+def bibtex_fingerprint (lines, directory=None):
+    """
+    Keep the databases, the style and the first citation of each key, in
+    order. Like BibTeX, follow the .aux files of included documents.
+    Their paths are relative to directory, by default the one containing
+    the file read by lines, where LaTeX wrote them and BibTeX runs.
+    """
+    if directory is None:
+        directory = os.path.dirname (getattr (lines, 'name', ''))
+    cited = set ()
+    def rec (lines):
+        for line in lines:
+            match = re_bibtex_aux.match (line)
+            if match is None:
+                continue
+            command, argument = match.groups ()
+            if command == b'citation':
+                for key in argument.split (b','):
+                    if key not in cited:
+                        cited.add (key)
+                        yield b'\\citation ' + key + b'\n'
+            elif command == b'@input':
+                try:
+                    included = open (os.path.join (directory,
+                                                   os.fsdecode (argument)), 'rb')
+                except OSError:
+                    yield b'\\@input ' + argument + b'\n'
+                    continue
+                with included:
+                    yield from rec (included)
+            else:
+                yield match.group (0) + b'\n'
+    return rec (lines)
+
+re_biber_citekey = re.compile (rb'<bcf:citekey[^>]*>([^<]*)</bcf:citekey>')
+
+def biber_fingerprint (lines):
+    """
+    Keep the first citation of each key in each section, in order, and
+    all the rest of the control file (options, data sources...) except
+    indentation and comments.
+    """
+    cited = set ()
+    for line in lines:
+        line = line.strip ()
+        match = re_biber_citekey.match (line)
+        if match is not None:
+            key = match.group (1)
+            if key not in cited:
+                cited.add (key)
+                yield b'citekey ' + key + b'\n'
+        elif line and not line.startswith (b'<!--'):
+            if line.startswith (b'<bcf:section '):
+                cited = set ()
+            yield line + b'\n'
+
+rubber.contents.register ('bibtex', bibtex_fingerprint)
+rubber.contents.register ('biber', biber_fingerprint)
 
 class BibToolDep (rubber.depend.Node):
 
-    def __init__ (self):
-        super ().__init__ ()
+    def __init__ (self, graph):
+        super ().__init__ (graph)
         self.tool = "bibtex"
         self.environ = os.environ.copy ()
         self.bib_paths = rubber.util.explode_path ("BIBINPUTS")
         self.bst_paths = rubber.util.explode_path ("BSTINPUTS")
+        # Subclasses set the file listing the citations, and the
+        # rubber.contents strategy extracting what the tool reads.
+        self.citations = None
+        self.strategy = 'bibtex'
+        # The databases, by name in the document.
+        self.databases = {}
+        # The BibPruneDep, after a 'prune' directive.
+        self.pruner = None
+        # The directory where the tool runs, or None for the current one.
+        # It must be set to the build directory of the document, since
+        # the tool reads the auxiliary files included by the main one
+        # relatively to its working directory.
+        self.directory = None
+
+    def snapshot (self, source):
+        if source == self.citations:
+            return rubber.contents.snapshot (source, self.strategy)
+        if source in self.databases.values ():
+            # Changes to entries that are not cited do not matter.
+            return cited_snapshot (source, self.citations, self.strategy)
+        return super ().snapshot (source)
 
     def do_path (self, args):
         if len (args) != 1:
@@ -30,18 +123,65 @@ class BibToolDep (rubber.depend.Node):
         path = args [0]
         self.bib_paths.insert (0, path)
 
+    def do_prune (self, args):
+        if len (args) != 0:
+            raise rubber.SyntaxError (_("invalid syntax for directive '{}'")
+                                      .format ('prune'))
+        if self.pruner is not None:
+            return
+        self.pruner = BibPruneDep (self)
+        for name, filename in self.databases.items ():
+            copy = self.pruner.add_database (name, filename)
+            if copy != filename and filename in self.sources:
+                self.remove_source (filename)
+                self.add_source (copy)
+
+    def add_database (self, name, filename):
+        """Register a database, found as filename, for the tool."""
+        self.databases [name] = filename
+        if self.pruner is not None:
+            filename = self.pruner.add_database (name, filename)
+        self.add_source (filename)
+
+    def tool_path (self, path):
+        """Return the path as seen from the directory where the tool runs."""
+        if self.directory is None:
+            return path
+        return os.path.relpath (path, self.directory)
+
+    def search_path (self, paths):
+        """
+        Return the value of a search path variable for the tool. When it
+        runs in another directory, the relative elements are made
+        absolute, and the current directory is searched first.
+        """
+        if self.directory is None:
+            return ":".join (paths)
+        cwd = os.getcwd ()
+        return ":".join ([cwd] + [p and os.path.join (cwd, p)
+                                  for p in paths or [""]])
+
     def run (self):
         # command might have been updated in the mean time, so get it now
-        self.environ["BIBINPUTS"] = ":".join (self.bib_paths)
-        self.environ["BSTINPUTS"] = ":".join (self.bst_paths)
+        self.environ["BIBINPUTS"] = self.search_path (self.bib_paths)
+        if self.pruner is not None:
+            # The copies hide the original databases.
+            self.environ["BIBINPUTS"] = self.search_path (
+                [self.pruner.directory] + (self.bib_paths or [""]))
+        self.environ["BSTINPUTS"] = self.search_path (self.bst_paths)
         command = self.build_command ()
 
         msg.info (_("running: %s") % " ".join (command))
-        process = subprocess.Popen (command,
-            stdin = subprocess.DEVNULL,
-            stdout = subprocess.DEVNULL,
-            env = self.environ)
-        if process.wait() != 0:
+        if self.directory is not None:
+            msg.debug (_("  in directory %s") % self.directory)
+        with rubber.trace.span (command [0], 'process', argv=command):
+            process = subprocess.Popen (command,
+                stdin = subprocess.DEVNULL,
+                stdout = subprocess.DEVNULL,
+                cwd = self.directory,
+                env = self.environ)
+            ret = process.wait ()
+        if ret != 0:
             msg.error (_("There were errors running %s.") % self.tool)
             return False
         return True
@@ -110,8 +250,9 @@ class BibTeXDep (BibToolDep):
         Initialise the bibiliography for the given document. The base name is
         that of the aux file from which citations are taken.
         """
-        super ().__init__ ()
+        super ().__init__ (document.env.graph)
 
+        self.doc = document
         self.log = document.basename(with_suffix=".log")
         self.aux = aux_basename + ".aux"
         self.bbl = aux_basename + ".bbl"
@@ -119,18 +260,19 @@ class BibTeXDep (BibToolDep):
         self.add_product (self.bbl)
         self.add_product (self.blg)
         self.add_source (self.aux)
+        self.citations = self.aux
+        self.directory = document.env.build_dir
         document.add_source (self.bbl)
 
         self.bst_file = None
         self.set_style ("plain")
-        self.db = {}
         self.crossrefs = None
 
     def build_command (self):
         ret = [ self.tool ]
         if self.crossrefs is not None:
             ret.append ("-min-crossrefs=" + self.crossrefs)
-        ret.append (self.aux)
+        ret.append (self.tool_path (self.aux))
         return ret
 
     #
@@ -166,10 +308,11 @@ class BibTeXDep (BibToolDep):
         for name in bibs.split (","):
             filename = self.find_bib (name)
             if filename is not None:
-                self.db[name] = filename
-                self.add_source (filename)
+                self.add_database (name, filename)
             else:
-                msg.error (_ ("cannot find bibliography resource %s") % name)
+                text = _("cannot find bibliography resource %s") % name
+                msg.error (text)
+                self.doc.add_missing (loc, text)
 
     def hook_bibliographystyle (self, loc, name):
         """
@@ -191,3 +334,429 @@ class BibTeXDep (BibToolDep):
         elif name not in [ "plain", "alpha" ]:
             # do not complain about default styles coming with bibtex
             msg.warning (_("cannot find bibliography style %s") % name)
+
+#
+# Index of the entries of the databases.
+#
+
+re_bib_entry = re.compile (rb'@\s*([A-Za-z]+)\s*([{(])')
+re_bib_delimiters = {
+    b'{': re.compile (rb'[{}]'),
+    b'(': re.compile (rb'[{})]'),
+}
+re_bib_parents = re.compile (
+    rb'(?<![\w-])(crossref|xdata|xref|related|entryset|ids)'
+    rb'\s*=\s*[{"]([^}"]*)[}"]', re.I)
+
+def bib_entries (data, pos=0, stop=None):
+    """
+    Split the contents of a .bib database (between pos and stop), and
+    yield (kind, key, start, end) for each entry, where kind is the
+    lower-case entry type and data [start:end] is the whole entry. The
+    key is None for @string, @preamble and @comment. BibTeX ignores the
+    text between entries.
+    """
+    if stop is None:
+        stop = len (data)
+    while True:
+        match = re_bib_entry.search (data, pos, stop)
+        if match is None:
+            return
+        kind = match.group (1).lower ()
+        end = stop
+        closed = False
+        depth = 0
+        for delimiter in re_bib_delimiters [match.group (2)].finditer (
+                data, match.end (), stop):
+            if delimiter.group () == b'{':
+                depth += 1
+            elif depth:
+                depth -= 1
+            else:
+                end = delimiter.end ()
+                closed = True
+                break
+        if kind in (b'string', b'preamble', b'comment'):
+            key = None
+        else:
+            key = data [match.end ():end - closed].split (b',', 1) [0].strip ()
+        yield kind, key, match.start (), end
+        pos = end
+
+class BibIndex:
+    """
+    The entries of a .bib database, in order, as tuples (kind, key,
+    start, end, digest, parents, aliases): key is lower-case (None for
+    @string, @preamble and @comment), data [start:end] is the text of the
+    entry, digest its MD5, parents the keys it refers to by crossref,
+    xdata, xref, related or entryset, and aliases the other keys it may
+    be cited with (the ids field of biblatex).
+
+    Indexes are stored in the cache directory (see
+    rubber.util.cache_directory), so that all the documents sharing a
+    database share its index. When the database changes, only the part
+    between the first and the last modified entries is parsed again.
+    """
+    header = 'rubber bib index, format 3\n'
+
+    def __init__ (self, path):
+        self.path = path
+        # The fingerprint of the database described by the entries,
+        # or None if they must be checked.
+        self.fingerprint = None
+        self.size = 0
+        self.entries = []
+        self.parents = {}
+
+    def storage (self):
+        name = hashlib.sha256 (os.fsencode (os.path.abspath (self.path)))
+        return os.path.join (rubber.util.cache_directory (), 'bib',
+                             name.hexdigest ())
+
+    def set_entries (self, entries, size):
+        self.entries = entries
+        self.size = size
+        # key -> keys needed with it, with the aliases resolved
+        self.parents = {}
+        for entry in entries:
+            if entry [1] is not None:
+                self.parents.setdefault (entry [1], []).extend (entry [5])
+                for alias in entry [6]:
+                    self.parents.setdefault (alias, []).append (entry [1])
+                # Biber also prints a set when one of its members is
+                # cited alone.
+                if entry [0] == b'set':
+                    for member in entry [5]:
+                        self.parents.setdefault (member, []).append (entry [1])
+
+    # Keys may be empty or contain any character, so that they are
+    # stored in hexadecimal after a '=', and None as '-'.
+
+    @staticmethod
+    def encode (key):
+        if key is None:
+            return b'-'
+        return b'=' + key.hex ().encode ()
+
+    @staticmethod
+    def decode (field):
+        if field == b'-':
+            return None
+        if not field.startswith (b'='):
+            raise ValueError ('invalid key field %r' % field)
+        return bytes.fromhex (field [1:].decode ())
+
+    @staticmethod
+    def encode_list (keys):
+        if not keys:
+            return b'-'
+        return b'=' + b','.join (key.hex ().encode () for key in keys)
+
+    @staticmethod
+    def decode_list (field):
+        if field == b'-':
+            return []
+        if not field.startswith (b'='):
+            raise ValueError ('invalid key list %r' % field)
+        return [bytes.fromhex (key.decode ())
+                for key in field [1:].split (b',')]
+
+    def load (self):
+        try:
+            f = open (self.storage (), 'rb')
+        except OSError:
+            return
+        with f:
+            written = os.fstat (f.fileno ()).st_mtime_ns
+            if f.readline () != self.header.encode ():
+                return
+            # A corrupt index is ignored, and rewritten by bib_index.
+            try:
+                size, mtime, inode = (int (x) for x in f.readline ().split ())
+                entries = []
+                for line in f:
+                    kind, start, end, digest, key, parents, aliases \
+                        = line.split ()
+                    entries.append ((kind, self.decode (key),
+                                     int (start), int (end),
+                                     bytes.fromhex (digest.decode ()),
+                                     self.decode_list (parents),
+                                     self.decode_list (aliases)))
+            except ValueError as e:
+                msg.debug (_("ignoring the corrupt index of %s: %s"),
+                           self.path, e)
+                return
+        self.set_entries (entries, size)
+        # Like rubber.contents.load, only trust fingerprints older
+        # than the storage.
+        if mtime < written:
+            self.fingerprint = (size, mtime, inode)
+
+    def save (self):
+        path = self.storage ()
+        try:
+            os.makedirs (os.path.dirname (path), exist_ok=True)
+            with tempfile.NamedTemporaryFile (dir=os.path.dirname (path),
+                                              delete=False) as f:
+                f.write (self.header.encode ())
+                f.write (b'%i %i %i\n' % self.fingerprint)
+                for kind, key, start, end, digest, parents, aliases \
+                        in self.entries:
+                    f.write (b'%s %i %i %s %s %s %s\n' % (
+                        kind, start, end, digest.hex ().encode (),
+                        self.encode (key), self.encode_list (parents),
+                        self.encode_list (aliases)))
+            os.replace (f.name, path)
+        except OSError as e:
+            msg.debug (_("cannot save the index of %s: %s"), self.path, e)
+
+    def update (self, data):
+        """
+        Describe data, the new contents of the database, reusing the
+        entries left unchanged at the beginning and at the end.
+        """
+        old = self.entries
+        # An entry is unchanged if its text is, and if no new entry
+        # appeared just before (resp. after) it.
+        head = 0
+        gap = 0
+        while head < len (old):
+            kind, key, start, end, digest, parents, aliases = old [head]
+            if end > len (data) \
+               or re_bib_entry.search (data, gap, start) is not None \
+               or hashlib.md5 (data [start:end]).digest () != digest:
+                break
+            gap = end
+            head += 1
+        shift = len (data) - self.size
+        tail = len (old)
+        following = len (data)
+        while head < tail:
+            kind, key, start, end, digest, parents, aliases = old [tail - 1]
+            start += shift
+            end += shift
+            if start < gap or following < end \
+               or re_bib_entry.search (data, end, following) is not None \
+               or hashlib.md5 (data [start:end]).digest () != digest:
+                break
+            following = start
+            tail -= 1
+        entries = list (bib_entries (data, gap, following))
+        if entries and entries [-1] [3] == following < len (data):
+            # The last new entry may not be closed before the next old
+            # one, which it would then contain.
+            tail = len (old)
+            following = len (data)
+            entries = list (bib_entries (data, gap, following))
+        msg.debug (_("%s: %i entries unchanged, parsed bytes %i to %i"),
+                   self.path, head + len (old) - tail, gap, following)
+        middle = []
+        for kind, key, start, end in entries:
+            parents = []
+            aliases = []
+            for match in re_bib_parents.finditer (data, start, end):
+                keys = aliases if match.group (1).lower () == b'ids' \
+                    else parents
+                keys.extend (other.strip ().lower ()
+                             for other in match.group (2).split (b','))
+            middle.append ((kind, key if key is None else key.lower (),
+                            start, end, hashlib.md5 (data [start:end]).digest (),
+                            parents, aliases))
+        self.set_entries (old [:head] + middle
+            + [(kind, key, start + shift, end + shift, digest, parents, aliases)
+               for kind, key, start, end, digest, parents, aliases
+               in old [tail:]],
+            len (data))
+
+    def select (self, keys):
+        """
+        The entries read by BibTeX or Biber for the given set of
+        lower-case keys: these entries (or the entries having them as
+        aliases), the entries they refer to and the sets containing them
+        (recursively), and all @string and @preamble definitions, in
+        their original order.
+        """
+        wanted = set (keys)
+        todo = list (keys)
+        while todo:
+            for parent in self.parents.get (todo.pop (), ()):
+                if parent not in wanted:
+                    wanted.add (parent)
+                    todo.append (parent)
+        return [entry for entry in self.entries
+                if entry [0] != b'comment'
+                and (entry [1] is None or entry [1] in wanted)]
+
+    def snapshot (self, keys):
+        """
+        A checksum only depending on the entries selected for keys, in
+        the format of rubber.contents.snapshot.
+        """
+        result = hashlib.md5 ()
+        for entry in self.select (keys):
+            result.update (entry [4])
+        return result.digest ()
+
+_indexes = {}
+_indexes_lock = threading.Lock ()
+
+def bib_index (path):
+    """The up-to-date BibIndex of a database, or None if it is missing."""
+    with _indexes_lock:
+        try:
+            st = os.stat (path)
+        except FileNotFoundError:
+            return None
+        fprint = rubber.contents.fingerprint (st)
+        index = _indexes.get (path)
+        if index is None:
+            index = _indexes [path] = BibIndex (path)
+            index.load ()
+        if index.fingerprint != fprint:
+            with open (path, 'rb') as f:
+                index.update (f.read ())
+            index.fingerprint = fprint
+            index.save ()
+        return index
+
+def cited_keys (path, strategy):
+    """
+    The set of lower-case keys cited according to an .aux or .bcf file,
+    or None if all entries are cited (\\nocite{*}).
+    """
+    if strategy == 'biber':
+        fingerprint, prefix = biber_fingerprint, b'citekey '
+    else:
+        fingerprint, prefix = bibtex_fingerprint, b'\\citation '
+    keys = set ()
+    with open (path, 'rb') as lines:
+        for line in fingerprint (lines):
+            if line.startswith (prefix):
+                keys.add (line [len (prefix):-1].strip ().lower ())
+    if b'*' in keys:
+        return None
+    return keys
+
+def cited_snapshot (source, citations, strategy):
+    """
+    The snapshot of the database source for a tool reading the given
+    citations file, only depending on the cited entries.
+    """
+    try:
+        keys = cited_keys (citations, strategy)
+    except FileNotFoundError:
+        keys = None
+    if keys is not None:
+        index = bib_index (source)
+        if index is not None:
+            return index.snapshot (keys)
+    return rubber.contents.snapshot (source)
+
+#
+# Pruned copies of the databases (the 'prune' directive).
+#
+
+re_biber_datasource = re.compile (
+    rb'(<bcf:datasource[^>]*>)([^<]*)(</bcf:datasource>)')
+
+def _update (path, data):
+    """
+    Write data to path unless it already contains it, so that the
+    snapshot of an unchanged copy does not even need a checksum.
+    """
+    try:
+        with open (path, 'rb') as f:
+            if f.read () == data:
+                return
+    except FileNotFoundError:
+        pass
+    with open (path, 'wb') as f:
+        f.write (data)
+
+class BibPruneDep (rubber.depend.Node):
+    """
+    Copy the databases of a bibliography into a private directory,
+    keeping only what the tool reads for the current citations, so
+    that it does not parse huge shared databases again and again.
+    A copy is only rewritten when its contents change, so that
+    modifying an entry that is not cited does not run the tool.
+
+    BibTeX finds the copies through BIBINPUTS. For Biber, a copy of the
+    control file is written next to them, with their paths.
+    """
+    def __init__ (self, bib):
+        super ().__init__ (bib.graph)
+        self.citations = bib.citations
+        self.strategy = bib.strategy
+        self.directory = os.path.splitext (bib.citations) [0] + '.rubberbib'
+        # copy -> original database
+        self.copies = {}
+        # name in the document -> copy
+        self.names = {}
+        self.add_source (self.citations)
+        if self.strategy == 'biber':
+            self.bcf = os.path.join (self.directory,
+                                     os.path.basename (self.citations))
+            self.add_product (self.bcf)
+            bib.add_source (self.bcf)
+        else:
+            self.bcf = None
+
+    def snapshot (self, source):
+        if source == self.citations:
+            return rubber.contents.snapshot (source, self.strategy)
+        if source in self.copies.values ():
+            return cited_snapshot (source, self.citations, self.strategy)
+        return super ().snapshot (source)
+
+    def add_database (self, name, filename):
+        """
+        Return the path of the copy replacing the database, or filename
+        if it cannot be replaced (the tool would not look for the copy).
+        """
+        if os.path.isabs (name) or name.startswith ('.') \
+           or os.path.normpath (name) != name:
+            return filename
+        if not name.endswith ('.bib'):
+            name += '.bib'
+        copy = os.path.join (self.directory, name)
+        self.copies [copy] = filename
+        self.names [name] = copy
+        self.add_source (filename)
+        self.add_product (copy)
+        return copy
+
+    def run (self):
+        keys = cited_keys (self.citations, self.strategy)
+        for copy, original in self.copies.items ():
+            with open (original, 'rb') as f:
+                data = f.read ()
+            index = None if keys is None else bib_index (original)
+            if index is not None:
+                data = b''.join (data [entry [2]:entry [3]] + b'\n\n'
+                                 for entry in index.select (keys))
+            msg.debug (_("pruning %s into %s (%i bytes)"), original, copy,
+                       len (data))
+            os.makedirs (os.path.dirname (copy), exist_ok=True)
+            _update (copy, data)
+        if self.bcf is not None:
+            def rewrite (match):
+                name = os.fsdecode (match.group (2))
+                if name not in self.names and name + '.bib' in self.names:
+                    name += '.bib'
+                if name not in self.names:
+                    return match.group (0)
+                # Biber may run in another directory, see BibToolDep.
+                return match.group (1) \
+                    + os.fsencode (os.path.abspath (self.names [name])) \
+                    + match.group (3)
+            with open (self.citations, 'rb') as f:
+                data = re_biber_datasource.sub (rewrite, f.read ())
+            os.makedirs (self.directory, exist_ok=True)
+            _update (self.bcf, data)
+        return True
+
+    def clean (self):
+        if os.path.isdir (self.directory):
+            msg.info (_("removing %s"), self.directory)
+            shutil.rmtree (self.directory)
@@ -7,16 +7,20 @@ This is the command line interface for Rubber.
 """
 
 import argparse
+import hashlib
 import os.path
 import sys
 import shutil
 import tempfile
+import rubber.artifacts
+import rubber.contents
 # bzip2 and/or gzip may be imported depending on command line options.
 import rubber.converters.compressor
 import rubber.converters.latex
 import rubber.converters.literate
 import rubber.depend
 import rubber.environment
+import rubber.trace
 from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
@@ -89,15 +93,28 @@ def parse_opts (command_name):
         place    = '.',
         prologue = [],
     )
+    build    = parser.add_mutually_exclusive_group ()
     compress = parser.add_mutually_exclusive_group ()
     place    = parser.add_mutually_exclusive_group ()
 
     # Non-mode options, sorted by short name, else by long name.
 
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('--artifact-cache', nargs='?',
+            const=rubber.artifacts.default_location (), metavar='DIR|URL',
+            help='reuse the results of conversions stored in DIR'
+            + ' (default %(const)s) or on the server at URL')
+        parser.add_argument ('--artifact-cache-size', type=int, default=1024,
+            metavar='MB', help='evict old conversion results when the'
+            + ' cache directory exceeds MB megabytes (default %(default)i)')
+
     compress.add_argument ('-b', '--bzip2', action='store_const',
         const='bzip2', dest='compress',
         help='compress the final document with bzip2')
 
+    build.add_argument ('--build-dir', metavar='DIR',
+        help='write the auxiliary files and the products of LaTeX in DIR')
+
     parser.add_argument ('-c', '--command', action='append', dest='prologue',
         metavar='CMD', help='run the directive CMD before parsing')
 
@@ -113,6 +130,13 @@ def parse_opts (command_name):
     parser.add_argument ('-e', '--epilogue', action='append', metavar='CMD',
         help='run the directive CMD after parsing')
 
+    parser.add_argument ('--draft-graphics', action='append_const', dest='prologue',
+        const='set draft_graphics yes',
+        help="shortcut for -c 'set draft_graphics yes'")
+    parser.add_argument ('--fail-fast', action='append_const', dest='prologue',
+        const='set fail_fast yes',
+        help="shortcut for -c 'set fail_fast yes'")
+
     if command_name == RUBBER_PLAIN:
         mode.add_argument ('-f', '--force', action='store_true',
             help='force at least one compilation')
@@ -129,6 +153,19 @@ def parse_opts (command_name):
     parser.add_argument ('-I', '--texpath', action='append', metavar='DIR',
         help='add DIR to the search path for LaTeX')
 
+    class JobsAction (argparse.Action):
+        def __call__(self, parser, namespace, values, option_string=None):
+            if values is None:
+                values = os.cpu_count () or 1
+            elif values < 1:
+                raise rubber.SyntaxError (_('invalid number of jobs: %i') % values)
+            namespace.jobs = values
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('-j', '--jobs', action=JobsAction, type=int,
+            nargs='?', default=1, metavar='NUM',
+            help='run up to NUM independent recipes at once (default'
+            + ' %(default)i, the number of processors if NUM is omitted)')
+
     parser.add_argument ('--jobname',
         help='set the job name for the first target')
 
@@ -186,6 +223,15 @@ def parse_opts (command_name):
     parser.add_argument ('--synctex', action='append_const', dest='prologue',
         const='synctex', help='shortcut for -c synctex')
 
+    build.add_argument ('--tmpfs', action='store_true',
+        help='write the auxiliary files in memory if possible,'
+        + ' then copy the final document back')
+
+    if command_name != RUBBER_INFO:
+        parser.add_argument ('--trace', metavar='FILE',
+            help='write a timeline of the build to FILE'
+            + ' (Chrome trace-event format)')
+
     parser.add_argument ('--unsafe', '--shell-escape', action='store_true',
         help='permits the document to run external commands')
 
@@ -252,7 +298,7 @@ def prepare_source (filename, command_name, env, options):
     if ext in rubber.converters.literate.literate_preprocessors.keys ():
         src = base + ".tex"
         # FIXME kill src_node
-        src_node = rubber.converters.literate.literate_preprocessors [ext] (src, path)
+        src_node = rubber.converters.literate.literate_preprocessors [ext] (env.graph, src, path)
         if command_name == RUBBER_PLAIN and not options.clean:
             if not options.unsafe:
                 raise rubber.SyntaxError (_("Running external commands requires --unsafe."))
@@ -273,6 +319,7 @@ def prepare_source (filename, command_name, env, options):
 def main (command_name):
     assert command_name in (RUBBER_PLAIN, RUBBER_PIPE, RUBBER_INFO)
 
+    trace = None
     try:
         options = parse_opts (command_name)
 
@@ -285,14 +332,30 @@ def main (command_name):
         else:
             args = options.source
 
+        if command_name != RUBBER_INFO and options.trace is not None:
+            # Before the first chdir, for relative paths.
+            trace = os.path.abspath (options.trace)
+            rubber.trace.enable ()
+
+        artifacts = None
+        if command_name != RUBBER_INFO and options.artifact_cache is not None:
+            # Before the first chdir, for relative paths.
+            artifacts = rubber.artifacts.open_store (
+                options.artifact_cache, options.artifact_cache_size << 20)
+
+        build_dir = options.build_dir
         if options.place is None: # --inplace
             # Compute all absolute paths before the first chdir.
             args = map (os.path.abspath, args)
+            if build_dir is not None:
+                build_dir = os.path.abspath (build_dir)
         elif options.place != '.': # non default --into
             print ("                       into", options.place)
             # Make arguments relative to the new directory,
             # go there then proceed normally.
             args = map (lambda p:os.path.relpath (p, options.place), args)
+            if build_dir is not None:
+                build_dir = os.path.relpath (build_dir, options.place)
             try:
                 os.chdir (options.place)
             except OSError as e:
@@ -319,6 +382,14 @@ def main (command_name):
             # in case of build mode, preprocessors will be run as part of
             # prepare_source.
             env = rubber.environment.Environment ()
+            env.artifacts = artifacts
+            if options.tmpfs:
+                env.build_dir = tmpfs_build_dir (src, options)
+            else:
+                env.build_dir = build_dir
+            if env.build_dir is not None and command_name != RUBBER_INFO \
+               and not (command_name == RUBBER_PLAIN and options.clean):
+                os.makedirs (env.build_dir, exist_ok=True)
             src = prepare_source (src, command_name, env, options)
 
             # safe mode is off during the prologue
@@ -347,6 +418,15 @@ def main (command_name):
             # safe mode is enforced for anything that comes from the .tex file
             env.is_in_unsafe_mode_ = options.unsafe
 
+            if command_name == RUBBER_PLAIN and not options.clean:
+                env.graph.signature = signature (options, read=True)
+                if not options.force and up_to_date (env):
+                    msg.info (_("nothing to be done for %s"), env.main.source ())
+                    if options.tmpfs:
+                        copy_back (env)
+                    report (options, env)
+                    continue
+
             env.main.parse()
 
             saved_vars = env.main.vars.copy ()
@@ -361,12 +441,12 @@ def main (command_name):
                 if options.compress == 'gzip':
                     import gzip
                     env.final = rubber.converters.compressor.Node (
-                        gzip.GzipFile, '.gz', filename)
+                        env.graph, gzip.GzipFile, '.gz', filename)
                 else:
                     assert options.compress == 'bzip2'
                     import bz2
                     env.final = rubber.converters.compressor.Node (
-                        bz2.BZ2File, '.bz2', filename)
+                        env.graph, bz2.BZ2File, '.bz2', filename)
 
             if command_name == RUBBER_PIPE:
                 process_source_pipe (env, src, options)
@@ -376,15 +456,22 @@ def main (command_name):
                 for node in env.final.all_producers ():
                     node.clean ()
                 cache_path = env.main.basename ('.rubbercache')
-                if os.path.exists (cache_path):
-                    msg.debug (_("removing %s"), cache_path)
-                    os.remove (cache_path)
+                for path in (cache_path, cache_path + '.lock'):
+                    if os.path.exists (path):
+                        msg.debug (_("removing %s"), path)
+                        os.remove (path)
             else:
                 build (options, RUBBER_PLAIN, env)
+                if options.tmpfs:
+                    copy_back (env)
+
+            if (command_name == RUBBER_PLAIN and options.clean) \
+               or (command_name == RUBBER_PIPE and not options.keep):
+                env.graph.clean_all_products ()
 
-        if (command_name == RUBBER_PLAIN and options.clean) \
-           or (command_name == RUBBER_PIPE and not options.keep):
-            rubber.depend.clean_all_products ()
+            if command_name == RUBBER_PLAIN and options.clean \
+               and env.build_dir is not None:
+                clean_build_dir (env, options.tmpfs)
 
     except KeyboardInterrupt:
         msg.warning (_("*** interrupted"))
@@ -395,6 +482,9 @@ def main (command_name):
     except rubber.GenericError as e:
         print ('error: ' + str (e), file=sys.stderr)
         sys.exit (2)
+    finally:
+        if trace is not None:
+            rubber.trace.save (trace)
 
 def build (options, command_name, env):
     """
@@ -403,38 +493,133 @@ def build (options, command_name, env):
     assert command_name == RUBBER_PIPE \
             or (command_name == RUBBER_PLAIN and not options.clean)
 
+    env.graph.jobs = options.jobs
+
     cache_path = env.main.basename ('.rubbercache')
-    if os.path.exists (cache_path):
+    # Concurrent runs on the same job would overwrite each other's files.
+    with rubber.util.lock_file (cache_path + '.lock'):
         if command_name == RUBBER_PLAIN and options.force:
             msg.debug (_('Ignoring cache file if any because of --force.'))
         else:
-            rubber.depend.load_cache (cache_path)
+            env.graph.load_cache (cache_path)
 
+        try:
+            if command_name == RUBBER_PLAIN and options.force:
+                ret = env.main.make ()
+                if env.final is not env.main:
+                    ret = env.final.make () or ret
+            else:
+                ret = env.final.make ()
+        except rubber.depend.MakeError as e:
+            msg.info (_("There were errors compiling %s: %s."),
+                      env.main.source (), e.msg)
+            number = options.maxerr
+            for err in e.errors:
+                if number == 0:
+                    msg.info(_("More errors."))
+                    break
+                display (options.short, **err)
+                number -= 1
+            # Ensure a message even with -q.
+            raise rubber.GenericError (_("Stopping because of compilation errors."))
+
+        # Even without a recompilation, new checksums may have been
+        # computed, and are worth remembering.
+        env.graph.save_cache (cache_path, env.final)
+        if not ret:
+            msg.info (_("nothing to be done for %s"), env.main.source ())
+
+    report (options, env)
+
+# The environment variables telling TeX and its tools where to find files.
+search_variables = ('TEXINPUTS', 'BIBINPUTS', 'BSTINPUTS', 'INDEXSTYLE',
+                    'TEXMFHOME', 'TEXMFCNF')
+
+def signature (options, read=False):
+    """
+    Summarize the options that change the dependency graph, so that the
+    result of a previous build is only trusted with the same ones. The
+    search paths of TeX are part of the options. If read is True, the
+    contents of the files read with -r are included too, since they are
+    not leaves of the graph.
+    """
+    words = [rubber.version.version, options.prologue, options.epilogue,
+             options.texpath, options.only, options.compress, options.unsafe,
+             options.build_dir, options.tmpfs,
+             [os.getenv (name) for name in search_variables]]
+    if read:
+        for cmd in options.prologue:
+            cmd = cmd.split (None, 1)
+            if len (cmd) == 2 and cmd [0] == 'read':
+                words.append (rubber.contents.cs2str (
+                    rubber.contents.snapshot (cmd [1])))
+    return hashlib.sha256 (repr (words).encode ()).hexdigest ()
+
+def tmpfs_build_dir (src, options):
+    """
+    The build directory used with --tmpfs. It is distinct for each source
+    and set of options, so that several configurations may be built at
+    once, and kept between runs.
+    """
+    key = hashlib.sha256 (repr ((os.path.abspath (src), signature (options)))
+                          .encode ()).hexdigest ()
+    return os.path.join (rubber.util.tmpfs_directory (), key [:16])
+
+def copy_back (env):
+    """
+    Copy the final product from the build directory to the current one,
+    unless the copy is already there.
+    """
+    product = env.final.primary_product ()
+    target = os.path.relpath (product, env.build_dir)
+    st = os.stat (product)
     try:
-        if command_name == RUBBER_PLAIN and options.force:
-            ret = env.main.make ()
-            if env.final is not env.main:
-                ret = env.final.make () or ret
+        copy = os.stat (target)
+    except FileNotFoundError:
+        pass
+    else:
+        if (copy.st_size, copy.st_mtime_ns) == (st.st_size, st.st_mtime_ns):
+            return
+    msg.info (_("copying %s to %s"), product, target)
+    shutil.copy2 (product, target)
+
+def clean_build_dir (env, tmpfs):
+    """
+    Remove the build directory once cleaned. The one used with --tmpfs
+    only contains files written by Rubber, and the copy of the final
+    product is also removed. Otherwise, only empty directories are
+    removed.
+    """
+    if tmpfs:
+        target = os.path.relpath (env.final.primary_product (), env.build_dir)
+        if os.path.exists (target):
+            msg.info (_("removing %s"), target)
+            os.remove (target)
+        if os.path.isdir (env.build_dir):
+            msg.debug (_("removing %s"), env.build_dir)
+            shutil.rmtree (env.build_dir)
+        return
+    for path, dirs, files in os.walk (env.build_dir, topdown=False):
+        try:
+            os.rmdir (path)
+        except OSError:
+            pass
         else:
-            ret = env.final.make ()
-    except rubber.depend.MakeError as e:
-        msg.info (_("There were errors compiling %s: %s."),
-                  env.main.source (), e.msg)
-        number = options.maxerr
-        for err in e.errors:
-            if number == 0:
-                msg.info(_("More errors."))
-                break
-            display (options.short, **err)
-            number -= 1
-        # Ensure a message even with -q.
-        raise rubber.GenericError (_("Stopping because of compilation errors."))
+            msg.debug (_("removing %s"), path)
 
-    if ret:
-        rubber.depend.save_cache (cache_path, env.final)
-    else:
-        msg.info (_("nothing to be done for %s"), env.main.source ())
+def up_to_date (env):
+    """
+    Check whether the previous build of the main document is still valid,
+    before parsing its sources.
+    """
+    cache_path = env.main.basename ('.rubbercache')
+    with rubber.util.lock_file (cache_path + '.lock'):
+        return env.graph.up_to_date (cache_path)
 
+def report (options, env):
+    """
+    Display the warnings requested on the command line.
+    """
     if options.warn_boxes or options.warn_misc or options.warn_refs:
         # FIXME
         log = env.main.log
@@ -513,9 +698,10 @@ def process_source_pipe (env, pipe_tempfile, options):
             for node in env.final.all_producers ():
                 node.clean ()
             cache_path = env.main.basename ('.rubbercache')
-            if os.path.exists (cache_path):
-                msg.debug (_("removing %s"), cache_path)
-                os.remove (cache_path)
+            for path in (cache_path, cache_path + '.lock'):
+                if os.path.exists (path):
+                    msg.debug (_("removing %s"), path)
+                    os.remove (path)
             if os.path.exists (pipe_tempfile):
                 msg.info (_("removing %s"), pipe_tempfile)
                 os.remove (pipe_tempfile)
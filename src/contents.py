@@ -4,27 +4,69 @@ log = logging.getLogger (__name__)
 import io
 import os.path
 
+# (path, strategy) -> (checksum, fingerprint)
 _cache = {}
 
-def snapshot (path):
+# Checksums computed by a previous invocation, see load.
+_persisted = {}
+
+# Ways to read files before hashing them, see register.
+_strategies = {}
+_by_suffix = {}
+
+def register (strategy, normalise, *suffixes):
+    """
+        Declare a strategy, that is a way to compute the snapshots of a
+        file type so that changes irrelevant to the programs reading it
+        are ignored.
+
+        normalise receives an iterable over the lines (as bytes) of the
+        file, and returns an iterable over the bytes that are actually
+        hashed. The strategy is used by default for paths with one of
+        the given suffixes, and on request for other paths (see snapshot).
+        A strategy name is stored in cache files, so its normalise
+        function should not change between versions without renaming it.
+    """
+    _strategies [strategy] = normalise
+    for suffix in suffixes:
+        _by_suffix [suffix] = strategy
+
+def default_strategy (path):
+    """The strategy used for path when the caller does not specify one."""
+    return _by_suffix.get (os.path.splitext (path) [1], 'bytes')
+
+def fingerprint (st):
+    """
+        The part of a stat result that we trust to change when the
+        contents of a file change.
+    """
+    return (st.st_size, st.st_mtime_ns, st.st_ino)
+
+def snapshot (path, strategy=None):
     """
-        A snapshot of the contents of an external file.
+        A snapshot of the contents of an external file, as seen through
+        the normalisation of the given strategy (see register).
 
         The special value NO_SUCH_FILE is returned when path does not
         refer to an existing external file. However, an exception is
         raised if an existing file vanishes between two calls.
 
-        The implementation trusts the operating system about modification
-        times, and assumes that an unchanged time stamp implies unchanged
-        contents. Malicious or unadvised users may change timestamps.
+        The implementation trusts the operating system about sizes,
+        modification times and inodes, and assumes that an unchanged
+        fingerprint implies unchanged contents. Malicious or unadvised
+        users may change timestamps.
 
         Moreover, an overwrite will not be detected if it is more recent
-        than the smallest interval representable by operating timestamps.
+        than the smallest interval representable by operating timestamps
+        and keeps the size of the file.
 
         The implementation relies on the MD5 hash to detect modified
         contents. For such a non-cryptographic use,  the probability of
         collision (2^-64) can be neglected for all practical needs.
     """
+    if strategy is None:
+        strategy = default_strategy (path)
+    key = (path, strategy)
     # We expect some files to be sources in many contexts, like the
     # main .tex document. In order to spare some checksum
     # computations, we cache the result.
@@ -32,26 +74,34 @@ def snapshot (path):
     # Distinct paths refering to the same external file should be
     # rare, so we do not attempt to detect them.
     try:
-        c, t = _cache [path]
+        c, t = _cache [key]
     except KeyError:
         c, t = None, None
 
-    if os.path.exists (path):
-        mtime = os.path.getmtime (path)
+    try:
+        st = os.stat (path)
+    except FileNotFoundError:
+        st = None
+
+    if st is not None:
+        f = fingerprint (st)
         if c is None:
-            log.debug ('%s contents are now watched', path)
-            c = _checksum_algorithm (path)
-            t = mtime
+            c, t = _persisted.pop (key, (None, None))
+            if t == f:
+                log.debug ('%s contents are now watched, checksum from cache', path)
+            else:
+                log.debug ('%s contents are now watched', path)
+                c = _checksum_algorithm (path, strategy)
+                t = f
         elif c == NO_SUCH_FILE:
             log.debug ('%s has been created', path)
-            c = _checksum_algorithm (path)
-            t = mtime
-        elif t == mtime:
-            log.debug ('%s has the same mtime', path)
+            c = _checksum_algorithm (path, strategy)
+            t = f
+        elif t == f:
+            log.debug ('%s has the same fingerprint', path)
         else:
-            assert t < mtime, 'mtime decreased: ' + path
-            t = mtime
-            checksum = _checksum_algorithm (path)
+            t = f
+            checksum = _checksum_algorithm (path, strategy)
             if checksum == c:
                 log.debug ('%s rewritten with same checksum', path)
             else:
@@ -64,15 +114,42 @@ def snapshot (path):
         assert c == NO_SUCH_FILE, path + ' vanished'
         log.debug ('%s does not exist yet',  path)
 
-    _cache [path] = (c, t)
+    _cache [key] = (c, t)
     return c
 
+def save ():
+    """
+        An iterable over (path, strategy, checksum, fingerprint) for
+        each existing file watched by this process, suitable for load.
+    """
+    for (path, strategy), (c, t) in _cache.items ():
+        if c is not None and c != NO_SUCH_FILE:
+            yield path, strategy, c, t
+
+def load (path, strategy, checksum, fprint, written):
+    """
+        Remember a checksum computed by a previous process, so that
+        snapshot may avoid reading the file again when its fingerprint
+        is unchanged. 'written' is the modification time (in ns) of the
+        storage. As a file modified during the same timestamp interval
+        may keep its fingerprint, more recent files are ignored.
+    """
+    key = (path, strategy)
+    if key not in _cache and fprint [1] < written:
+        _persisted [key] = (checksum, fprint)
+
 # Md5 values are represented as bytes. None is used above.
 NO_SUCH_FILE = bytes ()
+# The snapshot of an existing file with no (normalised) contents.
+EMPTY = hashlib.md5 ().digest ()
 
-def _checksum_algorithm (path):
+def _checksum_algorithm (path, strategy):
     with open (path, 'br') as stream:
         result = hashlib.md5 ()
+        if strategy != 'bytes':
+            for data in _strategies [strategy] (stream):
+                result.update (data)
+            return result.digest ()
         while True:
             data = stream.read (io.DEFAULT_BUFFER_SIZE)
             if not data:
@@ -3,14 +3,20 @@ This module contains code for file conversion, including implicit conversion
 rule management.
 """
 
-import re, imp, os.path
-from configparser import ConfigParser
+import re, imp
+from configparser import ConfigParser, NoOptionError, ParsingError
 import logging
 msg = logging.getLogger (__name__)
 from rubber.util import _
 import rubber.converters
+import rubber.listing
 
 re_variable = re.compile('[a-zA-Z]+')
+# A numbered back reference in the source template of a rule.
+re_backref = re.compile (r'\\([0-9]+)')
+# The end of a target pattern that only matches names with given suffixes,
+# like "\.(eps|pdf)" or "\.png", maybe followed by a common tail.
+re_suffixes = re.compile (r'\\\.(?:\((?P<alts>\w+(?:\|\w+)*)\)|(?P<ext>\w+))(?P<tail>\w*)\$?$')
 
 def expand_cases (string, vars):
     """
@@ -84,6 +90,27 @@ def expand_cases (string, vars):
     suffix = string[start:]
     return cases + [s + suffix for s in current], pos
 
+def compile_template (template):
+    """
+    Prepare a source template for expand_template, as a list of strings
+    and group numbers. Templates with other escapes than numbered back
+    references are kept as they are, for Match.expand.
+    """
+    parts = re_backref.split (template)
+    if any ('\\' in part for part in parts [::2]):
+        return template
+    return [int (part) if i % 2 else part for i, part in enumerate (parts)]
+
+def expand_template (match, template):
+    """
+    Like match.expand, for a template prepared by compile_template, but
+    without parsing it again.
+    """
+    if isinstance (template, str):
+        return match.expand (template)
+    return ''.join ((match.group (part) or '') if isinstance (part, int) else part
+                    for part in template)
+
 class Converter (object):
     """
     This class represents a set of translation rules that may be used to
@@ -104,6 +131,10 @@ class Converter (object):
     - convert(source, target, context, env):
         Produce a dependency node to produce 'target' from
         'source', using settings from the environment 'env'.
+
+    The rules are indexed by the suffixes their target may have, so that a
+    lookup only tries the rules that may apply. The result of check is
+    cached for each rule, source and target.
     """
     def __init__ (self, env):
         """
@@ -113,6 +144,12 @@ class Converter (object):
         self.env = env
         self.modules = {}
         self.rules = []
+        # suffix -> the rules only matching names with this suffix
+        self.by_suffix = {}
+        # The rules whose targets cannot be indexed, see index_rule.
+        self.generic = []
+        # (rule index, source, target) -> result of the module's check
+        self.checked = {}
 
     def read_ini (self, filename):
         """
@@ -145,7 +182,35 @@ class Converter (object):
             if not self.load_module(dict['rule']):
                 msg.warning (rubber.util._format ({'file':filename}, _("ignoring rule `%s' (module `%s' not found)") % (name, dict['rule'])))
             dict ["re_target"] = re.compile (dict ['target'] + '$')
+            dict ["templates"] = [compile_template (template) for template
+                in expand_cases (dict ['source'], {}) [0]]
+            dict ["index"] = len (self.rules)
             self.rules.append (dict)
+            self.index_rule (dict)
+
+    def index_rule (self, rule):
+        """
+        Register a rule under the suffixes its target may have. The target
+        pattern is only analysed when it ends with an escaped dot and
+        suffixes, other rules are tried for every target.
+        """
+        m = re_suffixes.search (rule ['target'])
+        if m is None:
+            self.generic.append (rule)
+            return
+        alts = m.group ('alts') or m.group ('ext')
+        for alt in alts.split ('|'):
+            self.by_suffix.setdefault (alt + m.group ('tail'), []).append (rule)
+
+    def rules_for (self, target):
+        """
+        Return the rules whose target may match the given name, in the
+        order they were read.
+        """
+        rules = self.by_suffix.get (target.rpartition ('.') [2], [])
+        if not self.generic:
+            return rules
+        return sorted (rules + self.generic, key=lambda rule: rule ['index'])
 
     def load_module (self, name):
         """
@@ -168,7 +233,7 @@ class Converter (object):
         this converter, i.e. if it matches one of the target regular
         expressions.
         """
-        for rule in self.rules:
+        for rule in self.rules_for (name):
             if rule ["re_target"].match(name):
                 return True
         return False
@@ -185,21 +250,20 @@ class Converter (object):
         """
         candidates = []
 
-        for rule in self.rules:
+        for rule in self.rules_for (target):
             match = rule ["re_target"].match(target)
             if not match:
                 continue
-            templates, _ = expand_cases(rule['source'], {})
-            for template in templates:
-                source = match.expand(template)
+            for template in rule ['templates']:
+                source = expand_template (match, template)
                 if source == target:
                     continue
-                if not os.path.exists(source):
+                if not rubber.listing.exists (source):
                     continue
-                candidates.append((rule['cost'], source, target, rule))
+                candidates.append((rule['cost'], source, rule['index'], rule))
 
-        candidates.sort()
-        for cost, source, target, rule in candidates:
+        candidates.sort(key=lambda candidate: candidate[:3])
+        for cost, source, index, rule in candidates:
             instance = context.copy ()
             for k, v in rule.items ():
                 instance [k] = v
@@ -210,7 +274,11 @@ class Converter (object):
                 continue
             module = self.modules[rule['rule']]
             if hasattr(module, 'check'):
-                if not module.check (source=source, target=target, context=instance):
+                key = (rule['index'], source, target)
+                if key not in self.checked:
+                    self.checked[key] = module.check (source=source,
+                        target=target, context=instance)
+                if not self.checked[key]:
                     continue
             return instance
 
@@ -223,8 +291,10 @@ class Converter (object):
         dependency node for the result.
         """
         module = self.modules[instance['rule']]
-        return module.convert(
+        node = module.convert(
                 source = instance['source'],
                 target = instance['target'],
                 context = instance,
                 env     = self.env)
+        node.artifacts = self.env.artifacts
+        return node
@@ -0,0 +1,239 @@
+# This file is covered by the GPL as part of Rubber.
+"""
+Conversion rule using resident worker processes.
+
+Some conversion tools take much longer to start than to convert a
+figure. This rule keeps processes of such a tool running until Rubber
+exits, and sends them the conversions one after the other. The rule file
+defines the following variables:
+- "tool" is the name of the worker, among the keys of 'workers' below,
+- "command" is a command line converting a single file, as for the shell
+  rule. It is used when no worker can be started, or when a worker fails.
+- "source" is the input file name,
+- "target" is the output file name.
+"""
+
+import atexit
+import logging
+msg = logging.getLogger (__name__)
+import os
+import re
+import select
+import subprocess
+import threading
+
+from rubber.depend import Shell
+from rubber.util import _, parse_line, prog_available
+import rubber.trace
+
+class Worker:
+    """
+    A running tool, reading conversion requests on its standard input and
+    answering each with a prompt on its standard output. Subclasses define
+    the command line, the prompt and the requests.
+    """
+    prompt = b'> '
+    # The time in seconds after which a tool that does not answer is
+    # considered as failed.
+    timeout = 120
+
+    def __init__ (self, argv):
+        msg.info (_("starting the worker: %s"), ' '.join (argv))
+        self.process = subprocess.Popen (argv,
+            stdin=subprocess.PIPE, stdout=subprocess.PIPE,
+            stderr=subprocess.DEVNULL)
+        self.output = self.process.stdout.fileno ()
+        if not self.wait_prompt ():
+            self.close ()
+            raise OSError (_("%s did not start") % argv [0])
+
+    def wait_prompt (self):
+        """
+        Read the output of the tool until it prompts for the next request.
+        Return False if the tool exits or stops answering instead.
+        """
+        answer = b''
+        while not answer.endswith (self.prompt):
+            if not select.select ((self.output,), (), (), self.timeout) [0]:
+                msg.info (_("%s did not answer in %i seconds"),
+                          self.process.args [0], self.timeout)
+                return False
+            data = os.read (self.output, 4096)
+            if not data:
+                return False
+            answer += data
+        return True
+
+    def request (self, source, target):
+        """
+        The line asking for a conversion, or None if the tool cannot
+        receive these file names.
+        """
+        raise NotImplementedError
+
+    def convert (self, source, target):
+        """
+        Convert source into target. Return False on failure, the worker
+        cannot be used anymore then.
+        """
+        # The worker keeps the directory it was started in, while
+        # Rubber changes directory for each document with --inplace.
+        source = os.path.abspath (source)
+        target = os.path.abspath (target)
+        line = self.request (source, target)
+        if line is None:
+            return False
+        # Remove the old target, so that its existence proves success.
+        if os.path.exists (target):
+            os.remove (target)
+        try:
+            self.process.stdin.write (line.encode () + b'\n')
+            self.process.stdin.flush ()
+        except OSError:
+            return False
+        return self.wait_prompt () and os.path.exists (target)
+
+    def close (self):
+        try:
+            self.process.stdin.close ()
+            self.process.wait (timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.process.kill ()
+            self.process.wait ()
+
+class Inkscape (Worker):
+    """
+    The interactive shell of Inkscape 1.2 or later, which receives actions
+    separated by semicolons.
+    """
+    def __init__ (self):
+        try:
+            version = subprocess.run (('inkscape', '--version'),
+                stdin=subprocess.DEVNULL, stdout=subprocess.PIPE,
+                stderr=subprocess.DEVNULL).stdout
+        except OSError as e:
+            raise OSError (_("cannot run inkscape: %s") % e)
+        m = re.search (rb'Inkscape ([0-9]+)\.([0-9]+)', version)
+        if m is None or (int (m.group (1)), int (m.group (2))) < (1, 2):
+            raise OSError (_("inkscape is older than 1.2"))
+        super ().__init__ (('inkscape', '--shell'))
+
+    def request (self, source, target):
+        if any (c in name for name in (source, target) for c in ';\n'):
+            return None
+        return 'file-open:%s;export-filename:%s;export-do;file-close' \
+            % (source, target)
+
+workers = {
+    'inkscape': Inkscape,
+}
+
+class Pool:
+    """
+    The workers of a tool, started on demand, up to one for each recipe
+    running at the same time.
+    """
+    def __init__ (self, tool):
+        self.tool = tool
+        self.idle = []
+        self.started = 0
+        # Set once a worker failed to start.
+        self.broken = False
+        self.condition = threading.Condition ()
+
+    def acquire (self, limit):
+        """
+        Return an idle worker, starting a new one if less than limit are
+        running, or None if the tool cannot be used.
+        """
+        with self.condition:
+            while not self.idle and self.started >= limit and not self.broken:
+                self.condition.wait ()
+            if self.broken:
+                return None
+            if self.idle:
+                return self.idle.pop ()
+            self.started += 1
+        try:
+            return workers [self.tool] ()
+        except OSError as e:
+            msg.info (_("cannot start the %s worker: %s"), self.tool, e)
+            with self.condition:
+                self.started -= 1
+                self.broken = True
+                self.condition.notify_all ()
+            return None
+
+    def release (self, worker, usable):
+        """Make a worker available again, or stop it if it failed."""
+        if not usable:
+            worker.close ()
+        with self.condition:
+            if usable:
+                self.idle.append (worker)
+            else:
+                self.started -= 1
+            self.condition.notify ()
+
+    def close (self):
+        with self.condition:
+            for worker in self.idle:
+                worker.close ()
+            self.idle = []
+
+# tool -> Pool
+pools = {}
+pools_lock = threading.Lock ()
+
+def get_pool (tool):
+    with pools_lock:
+        if not pools:
+            atexit.register (close_all)
+        if tool not in pools:
+            pools [tool] = Pool (tool)
+        return pools [tool]
+
+def close_all ():
+    """Stop all the workers, called when Rubber exits."""
+    with pools_lock:
+        for pool in pools.values ():
+            pool.close ()
+
+class BatchShell (Shell):
+    """
+    A conversion made by a worker of a tool, or by a single command if
+    the worker cannot make it.
+    """
+    def __init__ (self, graph, command, tool, source, target):
+        super ().__init__ (graph, command)
+        self.tool = tool
+        self.source = source
+        self.target = target
+        self.add_product (target)
+        self.add_source (source)
+
+    def run (self):
+        if self.tool in workers:
+            pool = get_pool (self.tool)
+            worker = pool.acquire (self.graph.jobs)
+            if worker is not None:
+                msg.info (_("converting %s into %s with %s"),
+                          self.source, self.target, self.tool)
+                with rubber.trace.span (self.tool, 'process',
+                                        argv=[self.tool, self.source, self.target]):
+                    done = worker.convert (self.source, self.target)
+                pool.release (worker, done)
+                if done:
+                    return True
+                msg.info (_("the %s worker failed on %s"), self.tool, self.source)
+        else:
+            msg.warning (_("no worker for %s, running it for each file"), self.tool)
+        return super ().run ()
+
+def check (source, target, context):
+    line = parse_line (context ['command'], context)
+    return prog_available (line [0])
+
+def convert (source, target, context, env):
+    return BatchShell (env.graph, parse_line (context ['command'], context),
+                       context ['tool'], source, target)
@@ -11,8 +11,8 @@ import rubber.depend
 
 class Node (rubber.depend.Node):
 
-    def __init__ (self, constructor, extension, source):
-        super ().__init__ ()
+    def __init__ (self, graph, constructor, extension, source):
+        super ().__init__ (graph)
         self.constructor = constructor
         self.target = source + extension
         self.source = source
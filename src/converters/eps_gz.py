@@ -16,13 +16,16 @@ re_bbox = re.compile("%[%\w]*BoundingBox:")
 
 class Dep (rubber.depend.Node):
 
-    def __init__ (self, target, source):
-        super ().__init__ ()
+    def __init__ (self, graph, target, source):
+        super ().__init__ (graph)
         self.add_product (target)
         self.add_source (source)
         self.source = source
         self.target = target
 
+    def signature (self):
+        return ()
+
     def run (self):
         """
         This method reads the source file (which is supposed to be a
@@ -51,4 +54,4 @@ class Dep (rubber.depend.Node):
         return False
 
 def convert (source, target, context, env):
-    return Dep (target, source)
+    return Dep (env.graph, target, source)
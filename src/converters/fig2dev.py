@@ -24,7 +24,7 @@ def convert (source, target, context, env):
         # used, that is for eps, pdf and png).
 
         language = target[target.rfind('.')+1:]
-        result = Shell (('fig2dev', '-L', language, source, target))
+        result = Shell (env.graph, ('fig2dev', '-L', language, source, target))
         result.add_product (target)
         result.add_source (source)
         return result
@@ -48,12 +48,12 @@ def convert (source, target, context, env):
             language = 'pstex'
             image_file = base_name + '.eps'
 
-        temp = Shell (('fig2dev', '-L', language, source, image_file))
+        temp = Shell (env.graph, ('fig2dev', '-L', language, source, image_file))
         temp.add_product (image_file)
         temp.add_source (source)
 
-        result = Shell (('fig2dev', '-L', language + '_t',
-                         '-p', image_reference, source, target))
+        result = Shell (env.graph, ('fig2dev', '-L', language + '_t',
+                                    '-p', image_reference, source, target))
         result.add_product (target)
         result.add_source (source)
         result.add_source (image_file)
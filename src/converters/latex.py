@@ -10,8 +10,10 @@ building a LaTeX document from start to finish.
 """
 
 import importlib
+import json
 import os, os.path, sys
 import re
+import tempfile
 import logging
 msg = logging.getLogger (__name__)
 import rubber.util
@@ -22,6 +24,70 @@ import rubber.latex_modules
 
 from rubber.tex import EOF, OPEN, SPACE, END_LINE
 
+#----  Auxiliary files  ----{{{1
+
+# The snapshots of these files only change when something read by the
+# next compilation changes. See rubber.contents.register.
+
+re_writefile = re.compile (rb'\\@writefile *\{([^}]*)\}')
+re_abspage = re.compile (rb'\\gdef *\\@abspage@last\{')
+
+def normalise_aux (lines):
+    """
+    The lines copied to other files (\\@writefile{toc}{...}) are only
+    processed at the end of the next run, so that only their order
+    relative to the other lines copied to the same file matters. The
+    total page count written by recent kernels may appear anywhere.
+    TeX ignores spaces at the end of lines, and empty lines are ignored
+    outside paragraphs.
+    """
+    written = {}
+    abspage = []
+    for line in lines:
+        line = line.rstrip ()
+        match = re_writefile.match (line)
+        if match:
+            written.setdefault (match.group (1), []).append (line)
+        elif re_abspage.match (line):
+            abspage.append (line)
+        elif line:
+            yield line + b'\n'
+    for target in sorted (written):
+        yield b'\0' + target + b'\n'
+        for line in written [target]:
+            yield line + b'\n'
+    yield b'\0\n'
+    for line in sorted (abspage):
+        yield line + b'\n'
+
+def normalise_aux_writes (lines):
+    """
+    Only keep the lines of an .aux file that are copied to other files.
+    LaTeX reports by itself the other changes that require another
+    compilation, see LaTeXDep.rerun.
+    """
+    written = {}
+    for line in lines:
+        line = line.rstrip ()
+        match = re_writefile.match (line)
+        if match:
+            written.setdefault (match.group (1), []).append (line)
+    for target in sorted (written):
+        yield b'\0' + target + b'\n'
+        for line in written [target]:
+            yield line + b'\n'
+
+def normalise_toc (lines):
+    """Ignore trailing spaces and empty lines, like TeX does here."""
+    for line in lines:
+        line = line.rstrip ()
+        if line:
+            yield line + b'\n'
+
+rubber.contents.register ('aux', normalise_aux, '.aux')
+rubber.contents.register ('aux-writes', normalise_aux_writes)
+rubber.contents.register ('toc', normalise_toc, '.toc', '.lof', '.lot')
+
 #----  Module handler  ----{{{1
 
 class Modules:
@@ -140,41 +206,107 @@ re_warning = re.compile(
 "(LaTeX|Package)( (?P<pkg>.*))? Warning: (?P<text>.*)$")
 re_online = re.compile("(; reported)? on input line (?P<line>[0-9]*)")
 re_ignored = re.compile("; all text was ignored after line (?P<line>[0-9]*).$")
+re_rerun = re.compile(r"\b[Rr]e-?run\b|may have changed")
 
 class LogCheck (object):
     """
     This class performs all the extraction of information from the log file.
-    For efficiency, the instances contain the whole file as a list of strings
-    so that it can be read several times with no disk access.
+    The log is parsed once into an index of all the diagnostics it contains,
+    and every query is then answered from this index. The index may also be
+    stored in a file, where it is reused as long as the log does not change.
     """
     #-- Initialization {{{2
 
     def __init__ (self):
         self.lines = None
-
-    def readlog (self, name, limit):
-        """
-        Read the specified log file, checking that it was produced by the
-        right compiler. Returns False if the log file is invalid or does not
-        exist.
+        self.name = None
+        # The file where the index is stored, if any, see readlog.
+        self.index_file = None
+        # The result of scan, see index.
+        self.diagnostics = None
+        self.has_errors = False
+        # The state of watch and feed.
+        self.skipping = False
+        self.error = False
+        self.failed = False
+
+    def readlog (self, name, index_file=None):
+        """
+        Prepare to read the specified log file, checking that it was
+        produced by the right compiler. Returns False if the log file is
+        invalid or does not exist. The lines themselves are only read when
+        the index is not found in index_file (see index).
         """
         self.lines = None
+        self.name = None
+        self.diagnostics = None
         try:
             with open (name, encoding='utf_8', errors='replace') as fp:
                 line = fp.readline ()
                 if not line or not re_loghead.match (line):
                     msg.debug (_('empty log'))
                     return False
-                # do not read the whole log unconditionally
-                whole_file = fp.read (limit)
-                self.lines = whole_file.split ('\n')
-                if fp.read (1) != '':
-                    # more data to be read
-                    msg.warning (_('log file is very long, and will not be read completely.'))
-            return True
         except IOError:
             msg.debug (_('IO Error with log'))
             return False
+        self.name = name
+        self.index_file = index_file
+        return True
+
+    def iter_lines (self):
+        """
+        Iterate over the lines of the log after the first one, without
+        their line feed. The file is read while the iteration goes, so
+        that logs of any size are read in constant memory. Without a log
+        file, the lines received by feed are used.
+        """
+        if self.name is None:
+            yield from self.lines or ()
+            return
+        with open (self.name, encoding='utf_8', errors='replace') as fp:
+            fp.readline ()
+            line = ""
+            for line in fp:
+                yield line [:-1] if line.endswith ("\n") else line
+            # Like str.split, end with an empty line after a line feed.
+            if line.endswith ("\n") or line == "":
+                yield ""
+
+    def watch (self, keep=True):
+        """
+        Prepare to receive the output of the compiler line by line while
+        it runs, see feed. If keep is True, the lines are kept, so that
+        they may be parsed instead of the log file if the compiler is
+        stopped. Otherwise, only the state of feed is maintained.
+        """
+        self.lines = [] if keep else None
+        self.name = None
+        self.diagnostics = None
+        self.skipping = False
+        self.error = False
+        self.failed = False
+
+    def feed (self, line):
+        """
+        Receive the next line of output. Return True once the text and the
+        context of an error have been received, in the same way as errors
+        and parse read them.
+        """
+        if self.lines is not None:
+            self.lines.append (line)
+        if self.failed:
+            return True
+        if self.skipping:
+            self.skipping = line.strip () != ""
+        elif self.error:
+            self.failed = re_line.match (line) is not None \
+                or line.startswith ("***") \
+                or line.startswith ("Type X to quit ")
+        elif re_badbox.match (line):
+            self.skipping = True
+        elif line.startswith ("!") and line.find ("pdfTeX warning") == -1:
+            self.error = True
+        return self.failed
 
     #-- Process information {{{2
 
@@ -182,25 +314,8 @@ class LogCheck (object):
         """
         Returns true if there was an error during the compilation.
         """
-        skipping = 0
-        for line in self.lines:
-            if line.strip() == "":
-                skipping = 0
-                continue
-            if skipping:
-                continue
-            m = re_badbox.match(line)
-            if m:
-                skipping = 1
-                continue
-            if line[0] == "!":
-                # We check for the substring "pdfTeX warning" because pdfTeX
-                # sometimes issues warnings (like undefined references) in the
-                # form of errors...
-
-                if line.find("pdfTeX warning") == -1:
-                    return 1
-        return 0
+        self.index ()
+        return self.has_errors
 
     #-- Information extraction {{{2
 
@@ -214,7 +329,7 @@ class LogCheck (object):
 
     def parse (self, errors=0, boxes=0, refs=0, warnings=0):
         """
-        Parse the log file for relevant information. The named arguments are
+        Extract information from the log file. The named arguments are
         booleans that indicate which information should be extracted:
         - errors: all errors
         - boxes: bad boxes
@@ -227,8 +342,75 @@ class LogCheck (object):
         - code: the piece of code that caused an error
         - file, line, last, pkg: as used by Message.format_pos.
         """
-        if not self.lines:
+        wanted = set ()
+        if errors:
+            wanted.add ("errors")
+        if boxes:
+            wanted.add ("boxes")
+        if refs:
+            wanted.add ("refs")
+        if warnings:
+            wanted.add ("warnings")
+        for category, d in self.index ():
+            if category in wanted:
+                yield dict (d)
+
+    def index (self):
+        """
+        Return the list of all diagnostics in the log, as pairs of the
+        name of the argument of parse that selects them and the dictionary
+        that parse returns. The log is only parsed by the first call, or
+        not at all when the index stored in index_file is still valid.
+        """
+        if self.diagnostics is not None:
+            return self.diagnostics
+        key = None
+        if self.name is not None and self.index_file is not None:
+            key = "%s %s" % (type (self).__name__,
+                rubber.contents.cs2str (rubber.contents.snapshot (self.name)))
+            self.load_index (key)
+        if self.diagnostics is None:
+            self.has_errors = False
+            self.diagnostics = list (self.scan ())
+            if key is not None:
+                self.save_index (key)
+        return self.diagnostics
+
+    def load_index (self, key):
+        try:
+            with open (self.index_file, encoding='utf_8') as f:
+                data = json.load (f)
+        except (IOError, ValueError):
             return
+        if not isinstance (data, dict) or data.get ("key") != key:
+            msg.debug (_("%s is out of date"), self.index_file)
+            return
+        msg.debug (_("reading the diagnostics of %s from %s"),
+                   self.name, self.index_file)
+        self.has_errors = data ["errors"]
+        self.diagnostics = [tuple (d) for d in data ["diagnostics"]]
+
+    def save_index (self, key):
+        """
+        Write the index to index_file. The file is replaced atomically, so
+        that concurrent readers see either the old or the new version.
+        """
+        directory, name = os.path.split (self.index_file)
+        try:
+            with tempfile.NamedTemporaryFile (mode='tw', encoding='utf_8',
+                    dir=directory or '.', prefix=name + '.', delete=False) as f:
+                # json.dumps is much faster than json.dump.
+                f.write (json.dumps ({"key": key, "errors": self.has_errors,
+                                      "diagnostics": self.diagnostics}))
+            os.replace (f.name, self.index_file)
+        except IOError as e:
+            msg.debug (_("cannot write %s: %s"), self.index_file, e)
+
+    def scan (self):
+        """
+        Parse the log for all the information parse may extract, yielding
+        pairs as described in index, and set has_errors as errors expects.
+        """
         last_file = None
         pos = [last_file]
         page = 1
@@ -239,7 +421,25 @@ class LogCheck (object):
         accu = ""      # accumulated text from the previous line
         macro = None   # the macro in which the error occurs
         cseqs = {}     # undefined control sequences so far
-        for line in self.lines:
+        blank = 0      # 1 if we are skipping text for has_errors
+        for line in self.iter_lines ():
+            # Any error makes the compilation fail, even when its context
+            # is missing.
+
+            if line.strip () == "":
+                blank = 0
+            elif blank:
+                pass
+            elif re_badbox.match (line):
+                blank = 1
+            elif line [0] == "!":
+                # We check for the substring "pdfTeX warning" because pdfTeX
+                # sometimes issues warnings (like undefined references) in the
+                # form of errors...
+
+                if line.find ("pdfTeX warning") == -1:
+                    self.has_errors = True
+
             # TeX breaks messages at 79 characters, just to make parsing
             # trickier...
 
@@ -280,14 +480,16 @@ class LogCheck (object):
                     parsing = 0
                     skipping = 1
                     pdfTeX = line.find("pdfTeX warning") != -1
-                    if error is not None and ((pdfTeX and warnings) or (errors and not pdfTeX)):
+                    if error is not None:
                         if pdfTeX:
+                            category = "warnings"
                             d = {
                                 "kind": "warning",
                                 "pkg": "pdfTeX",
                                 "text": error[error.find(":")+2:]
                             }
                         else:
+                            category = "errors"
                             d =    {
                                 "kind": "error",
                                 "text": error
@@ -306,28 +508,26 @@ class LogCheck (object):
                         if macro is not None:
                             d["macro"] = macro
                             macro = None
-                        yield d
+                        yield category, d
                 elif line[0] == "!":
                     error = line[2:]
                 elif line[0:3] == "***":
                     parsing = 0
                     skipping = 1
-                    if errors:
-                        yield    {
-                            "kind": "abort",
-                            "text": error,
-                            "why" : line[4:],
-                            "file": last_file
-                            }
+                    yield "errors", {
+                        "kind": "abort",
+                        "text": error,
+                        "why" : line[4:],
+                        "file": last_file
+                        }
                 elif line[0:15] == "Type X to quit ":
                     parsing = 0
                     skipping = 0
-                    if errors:
-                        yield    {
-                            "kind": "error",
-                            "text": error,
-                            "file": pos[-1]
-                            }
+                    yield "errors", {
+                        "kind": "error",
+                        "text": error,
+                        "file": pos[-1]
+                        }
                 continue
 
             if line.startswith ('!'):
@@ -359,11 +559,10 @@ class LogCheck (object):
                     if m:
                         info["line"] = m.group("line")
                         text = text[:m.start()] + text[m.end():]
-                    if warnings:
-                        info["text"] = text
-                        d = { "kind": "warning" }
-                        d.update( info )
-                        yield d
+                    info["text"] = text
+                    d = { "kind": "warning" }
+                    d.update( info )
+                    yield "warnings", d
                     prefix = None
                 continue
 
@@ -371,25 +570,23 @@ class LogCheck (object):
 
             m = re_reference.match(line)
             if m:
-                if refs:
-                    d =    {
-                        "kind": "warning",
-                        "text": _("Reference `%s' undefined.") % m.group("ref"),
-                        "file": pos[-1]
-                        }
-                    d.update( m.groupdict() )
-                    yield d
+                d =    {
+                    "kind": "warning",
+                    "text": _("Reference `%s' undefined.") % m.group("ref"),
+                    "file": pos[-1]
+                    }
+                d.update( m.groupdict() )
+                yield "refs", d
                 continue
 
             m = re_label.match(line)
             if m:
-                if refs:
-                    d =    {
-                        "kind": "warning",
-                        "file": pos[-1]
-                        }
-                    d.update( m.groupdict() )
-                    yield d
+                d =    {
+                    "kind": "warning",
+                    "file": pos[-1]
+                    }
+                d.update( m.groupdict() )
+                yield "refs", d
                 continue
 
             # Other warnings
@@ -413,20 +610,19 @@ class LogCheck (object):
 
             m = re_badbox.match(line)
             if m:
-                if boxes:
-                    mpos = { "file": pos[-1], "page": page }
-                    m = re_atline.search(line)
-                    if m:
-                        md = m.groupdict()
-                        for key in "line", "last":
-                            if md[key]: mpos[key] = md[key]
-                        line = line[:m.start()]
-                    d =    {
-                        "kind": "warning",
-                        "text": line
-                        }
-                    d.update( mpos )
-                    yield d
+                mpos = { "file": pos[-1], "page": page }
+                m = re_atline.search(line)
+                if m:
+                    md = m.groupdict()
+                    for key in "line", "last":
+                        if md[key]: mpos[key] = md[key]
+                    line = line[:m.start()]
+                d =    {
+                    "kind": "warning",
+                    "text": line
+                    }
+                d.update( mpos )
+                yield "boxes", d
                 skipping = 1
                 continue
 
@@ -451,6 +647,14 @@ class LogCheck (object):
         return self.parse(refs=1)
     def get_warnings (self):
         return self.parse(warnings=1)
+    def get_reruns (self):
+        """
+        The warnings asking for another compilation, like "Label(s) may
+        have changed" or longtable's "Table widths have changed".
+        """
+        for d in self.parse(warnings=1):
+            if re_rerun.search(d["text"]):
+                yield d
 
     def update_file (self, line, stack, last):
         """
@@ -486,39 +690,53 @@ class LogCheck (object):
 
 #----  Parsing and compiling  ----{{{1
 
-re_command = re.compile("%[% ]*rubber: *(?P<cmd>[^ ]*) *(?P<arg>.*).*")
+# The command line options that make each engine skip writing its output,
+# for the compilations before the last one.
+draft_options = {
+    'pdfTeX': '-draftmode',
+    'XeLaTeX': '-no-pdf',
+    'LuaLaTeX': '--draftmode',
+}
+
+re_command = re.compile(r"%[% ]*rubber: *(?P<cmd>[^ \n]*) *(?P<arg>[^\n]*)")
 
 class SourceParser (rubber.tex.Parser):
     """
     Extends the general-purpose TeX parser to handle Rubber directives in the
-    comment lines.
+    comment lines, and to keep its hooks in sync with those of the document.
     """
+    re_comment_line = re_command
+
     def __init__ (self, file, dep):
         super (SourceParser, self).__init__(file)
         self.latex_dep = dep
+        self.hooks_version = -1
 
-    def read_line (self):
-        while rubber.tex.Parser.read_line(self):
-            match = re_command.match(self.line.strip())
-            if match is None:
-                return True
+    def update_hooks (self):
+        """
+        Define the hooks of the document for 'next_hook', if they changed.
+        """
+        if self.hooks_version != self.latex_dep.hooks_version:
+            self.set_hooks(self.latex_dep.hooks.keys())
+            self.hooks_version = self.latex_dep.hooks_version
 
-            vars = self.latex_dep.vars.copy ()
-            vars ['line'] = self.pos_line
-            args = parse_line(match.group("arg"), vars)
+    def comment_line (self, match):
+        vars = self.latex_dep.vars.copy ()
+        vars ['line'] = self.pos_line
+        args = parse_line(match.group("arg"), vars)
 
-            self.latex_dep.command(match.group("cmd"), args, vars)
-        return False
+        self.latex_dep.command(match.group("cmd"), args, vars)
+        self.update_hooks()
 
     def skip_until (self, expr):
         regexp = re.compile(expr)
-        while rubber.tex.Parser.read_line(self):
-            match = regexp.match(self.line)
-            if match is None:
-                continue
-            self.line = self.line[match.end():]
-            self.pos_char += match.end()
-            return
+        self.skip_line()
+        while self.col < len(self.text):
+            match = regexp.match(self.text, self.col)
+            if match is not None:
+                self.move(match.end())
+                return
+            self.skip_line()
 
 class EndDocument (Exception):
     """ This is the exception raised when \\end{document} is found. """
@@ -543,6 +761,10 @@ class LaTeXDep (rubber.depend.Node):
     that matches the macro call.
     """
 
+    # The modules and the compilation itself use the files of the
+    # document, so the LaTeX loop always runs alone.
+    serial = True
+
     #--  Initialization  {{{2
 
     def __init__ (self, env, path, jobname):
@@ -557,7 +779,7 @@ class LaTeXDep (rubber.depend.Node):
         'jobname' specifies the job name to something else that
         the base of the file name.
         """
-        super ().__init__ ()
+        super ().__init__ (env.graph)
         self.env = env
 
         self.log = LogCheck()
@@ -570,9 +792,25 @@ class LaTeXDep (rubber.depend.Node):
         }
         self.arguments = []
         self.src_specials = ""
-        self.logfile_limit = 1000000
         self.program = 'latex'
         self.engine = 'TeX'
+        # The format loaded by the compilations, see the mylatexformat module.
+        self.format = None
+        # Whether the compilations before the last one are made in draft
+        # mode, whether a compilation has been made, and whether the last
+        # one was in draft mode.
+        self.draft = True
+        self.compiled = False
+        self.drafted = False
+        # Whether a compilation is stopped at its first error, and not
+        # even started when a file is missing, see add_missing.
+        self.fail_fast = False
+        self.missing = []
+        self.failed_preflight = False
+        # Whether large bitmaps are replaced by reduced copies, which the
+        # graphics module puts in input_dirs, searched before the others.
+        self.draft_graphics = False
+        self.input_dirs = []
         self.cmdline = ["\\nonstopmode", "\\input{%s}"]
 
         # the initial hooks:
@@ -611,6 +849,9 @@ class LaTeXDep (rubber.depend.Node):
 
         # FIXME interim solution for BibTeX module -- rewrite it.
         self.aux_files = []
+        # The snapshots of the lines copied from the .aux files to other
+        # files, before the last compilation. See rerun.
+        self.aux_writes_before = None
 
         # description of the building process:
 
@@ -653,7 +894,28 @@ class LaTeXDep (rubber.depend.Node):
         self.add_product (self.basename (with_suffix=".synctex.gz"))
 
     def basename (self, with_suffix=""):
-        return self.vars["job"] + with_suffix
+        return self.output_file (self.vars["job"] + with_suffix)
+
+    def add_missing (self, loc, text):
+        """
+        Record that a file needed by the document can be neither found nor
+        made, as explained by text at the given location. With fail_fast,
+        the document is then not compiled at all.
+        """
+        error = {"kind": "error", "text": text}
+        for key in ("file", "line"):
+            if loc.get (key) is not None:
+                error [key] = loc [key]
+        self.missing.append (error)
+
+    def output_file (self, name):
+        """
+        Return the path of a file that the compilation writes under the
+        given name, in the build directory if there is one.
+        """
+        if self.env.build_dir is None:
+            return name
+        return os.path.join (self.env.build_dir, name)
 
     def register_post_processor (self, old_suffix, new_suffix):
         if self.env.final != self \
@@ -709,11 +971,8 @@ class LaTeXDep (rubber.depend.Node):
         the included sources.
         """
         parser = SourceParser(file, self)
-        hooks_version = -1
         while True:
-            if hooks_version != self.hooks_version:
-                parser.set_hooks(self.hooks.keys())
-                hooks_version = self.hooks_version
+            parser.update_hooks()
             token = parser.next_hook()
             if token.cat == EOF:
                 break
@@ -727,7 +986,7 @@ class LaTeXDep (rubber.depend.Node):
                 elif arg == 'o':
                     args.append(parser.get_latex_optional_text())
             self.parser = parser
-            self.vars['line'] = parser.pos_line
+            self.vars['line'] = token.pos.line
             function(self.vars, *args)
 
     def process (self, path):
@@ -919,12 +1178,17 @@ class LaTeXDep (rubber.depend.Node):
         elif name in ('job',):
             msg.warning (_("variable %s is read-only, please see the manual") % name)
         elif name in ('logfile_limit',):
-                try:
-                    val = int (val)
-                except:
+            msg.warning (_("variable %s is obsolete, the log is always read completely (ignored)") % name)
+        elif name in ('max_attempts',):
+                if not val.isdigit () or int (val) < 1:
                     msg.warning (_("cannot set int variable %s to value %s (ignored)") % (name, val))
                 else:
-                    setattr (self, name, val)
+                    setattr (self, name, int (val))
+        elif name in ('draft', 'draft_graphics', 'fail_fast'):
+                if val not in ('yes', 'no'):
+                    msg.warning (_("cannot set boolean variable %s to value %s (ignored)") % (name, val))
+                else:
+                    setattr (self, name, val == 'yes')
         elif name in ('src-specials',):
             setattr (self, name, val)
         elif name in ('engine', 'file', 'line',):
@@ -1041,7 +1305,7 @@ class LaTeXDep (rubber.depend.Node):
             return
         file = self.input_file(filename, loc)
         if file:
-            self.new_aux_file (filename + ".aux")
+            self.new_aux_file (self.output_file (filename + ".aux"))
 
     def h_includeonly (self, loc, files):
         """
@@ -1141,12 +1405,16 @@ class LaTeXDep (rubber.depend.Node):
 
     #--  Compilation steps  {{{2
 
-    def compile (self):
+    def compile (self, draft=False):
         """
         Run one LaTeX compilation on the source. Return true on success or
-        false if errors occured.
+        false if errors occured. In draft mode, the output file is not
+        written.
         """
-        msg.info (_("compiling %s"), self.source)
+        if draft:
+            msg.info (_("compiling %s in draft mode"), self.source ())
+        else:
+            msg.info (_("compiling %s"), self.source ())
 
         file = self.source()
 
@@ -1155,11 +1423,16 @@ class LaTeXDep (rubber.depend.Node):
 
         cmd = [self.program]
 
+        if self.format is not None:
+            cmd.append ("-fmt=" + self.format)
+
         if self.set_job:
             if self.engine == "VTeX":
                 msg.error(_("I don't know how set the job name with VTeX."))
             else:
-                cmd.append("-jobname=" + self.basename ())
+                cmd.append("-jobname=" + self.vars["job"])
+
+        cmd.extend (self.output_options ())
 
         specials = self.src_specials
         if specials != "":
@@ -1179,6 +1452,9 @@ class LaTeXDep (rubber.depend.Node):
         if self.env.synctex:
             cmd.append ("-synctex=1")
 
+        if draft and self.can_draft ():
+            cmd.append (draft_options [self.engine])
+
         # arguments inserted by the document allowed only in unsafe mode, since
         # this could do arbitrary things such as enable shell escape (write18)
         if self.env.is_in_unsafe_mode_:
@@ -1188,18 +1464,25 @@ class LaTeXDep (rubber.depend.Node):
 
         cmd.extend (x.replace ("%s", file) for x in self.cmdline)
 
-        # Remove the CWD from elements in the path, to avoid potential problems
-        # with special characters if there are any (except that ':' in paths
-        # is not handled).
-
-        inputs = ":".join (self.env.path)
-
-        if inputs == "":
-            env = {}
-        else:
-            inputs = inputs + ":" + os.getenv("TEXINPUTS", "")
-            env = {"TEXINPUTS": inputs}
-        if rubber.util.execute (cmd, env=env) != 0:
+        if self.env.build_dir is not None:
+            # TeX does not create the directories of the .aux files of
+            # included sources.
+            for aux in self.aux_files:
+                os.makedirs (os.path.dirname (aux), exist_ok=True)
+
+        # Watch the errors while the compiler runs. Its output is the
+        # same as the log, so that the errors may be reported from it if
+        # the compiler is stopped before writing the whole log. It is
+        # only kept in memory when the compiler may be stopped.
+        self.log.watch (keep=self.fail_fast)
+        def out (line):
+            line = line.decode ('utf_8', errors='replace').rstrip ('\n')
+            return self.log.feed (line) and self.fail_fast
+        status = rubber.util.execute (cmd, env=self.texinputs (), out=out)
+        if self.log.failed and self.fail_fast:
+            msg.error (_("Stopped %s at the first error."), cmd [0])
+            return False
+        if status != 0:
             msg.error(_("Running %s resulted in a non-zero exit status."), cmd [0])
             return False
 
@@ -1208,16 +1491,48 @@ class LaTeXDep (rubber.depend.Node):
             return False
         if self.log.errors():
             return False
-        if not os.access (self.primary_product (), os.F_OK):
+        if not draft and not os.access (self.primary_product (), os.F_OK):
             msg.error (_("Output file `%s' was not produced."),
                        self.primary_product ())
             return False
         return True
 
+    def output_options (self):
+        """
+        Return the command line options that make TeX write in the build
+        directory, if any.
+        """
+        if self.env.build_dir is None:
+            return []
+        if self.engine == "VTeX":
+            msg.error (_("I don't know how to set the output directory with VTeX."))
+            return []
+        return ["-output-directory=" + self.env.build_dir]
+
+    def texinputs (self):
+        """
+        Return the environment variables that let TeX find the files in
+        the search path of the document, and in the build directory.
+        """
+        # Remove the CWD from elements in the path, to avoid potential problems
+        # with special characters if there are any (except that ':' in paths
+        # is not handled).
+
+        path = self.env.path
+        if self.env.build_dir is not None:
+            path = [self.env.build_dir] + path
+        path = self.input_dirs + path
+        inputs = ":".join (path)
+
+        if inputs == "":
+            return {}
+        inputs = inputs + ":" + os.getenv("TEXINPUTS", "")
+        return {"TEXINPUTS": inputs}
+
     def parse_log (self):
         logfile_name = self.basename (with_suffix=".log")
-        logfile_limit = self.logfile_limit
-        return self.log.readlog (logfile_name, logfile_limit)
+        return self.log.readlog (logfile_name,
+            index_file=self.basename (with_suffix=".logindex"))
 
     def pre_compile (self):
         """
@@ -1262,11 +1577,16 @@ class LaTeXDep (rubber.depend.Node):
 
     def clean (self):
         """
-        Run clean method of LaTeX modules.
+        Run clean method of LaTeX modules, and remove the index of the log
+        (see LogCheck.index).
         """
         msg.debug (_("cleaning LaTeX modules..."))
         for mod in self.modules.objects.values():
             mod.clean()
+        index_file = self.basename (with_suffix=".logindex")
+        if os.path.exists (index_file):
+            msg.info (_("removing %s"), index_file)
+            os.remove (index_file)
 
     #--  Building routine  {{{2
 
@@ -1279,22 +1599,87 @@ class LaTeXDep (rubber.depend.Node):
         parent class, the method returns True on success and False on
         failure.
         """
+        if self.fail_fast and self.missing:
+            # The compilation would fail anyway.
+            msg.error (_("Some files needed by %s are missing."), self.source ())
+            self.failed_preflight = True
+            return False
+
         if not self.pre_compile():
             return False
 
         # If an error occurs after this point, it will be while LaTeXing.
         self.failed_module = None
 
-        if not self.compile():
+        # When a previous build exists, the first compilation may well be
+        # the only one, so it writes the output. Other compilations are
+        # made in draft mode, and the output is written by finish once
+        # the auxiliary files are stable.
+        self.drafted = self.draft and self.can_draft () \
+            and (self.compiled or self.snapshots is None)
+        self.compiled = True
+        self.aux_writes_before = self.aux_writes ()
+        if not self.compile(draft=self.drafted):
             return False
         if not self.post_compile():
             return False
 
         return True
 
+    def can_draft (self):
+        """
+        Tell whether the engine can skip writing its output. The draft
+        mode of pdfTeX does not apply to DVI output (see the pdftex
+        module), which would be written by every compilation anyway.
+        """
+        return self.engine in draft_options \
+            and '\\pdfoutput=0' not in self.cmdline
+
+    def finish (self):
+        """
+        Write the output, if the last compilation was in draft mode.
+        """
+        if not self.drafted:
+            return True
+        self.drafted = False
+        return self.compile()
+
+    def rerun (self, changed):
+        """
+        LaTeX and its packages report in the log when they need another
+        compilation, for instance after changes in labels or citations,
+        or in files that Rubber does not watch. Changes in the .aux files
+        are only trusted to need one when they affect other files.
+        """
+        for warning in self.log.get_reruns ():
+            msg.debug (_("%s: LaTeX asks for another run"), self.source ())
+            return 'log: ' + warning ["text"]
+        if not changed \
+           or not set (changed).issubset (self.aux_files) \
+           or self.aux_writes () != self.aux_writes_before:
+            return super ().rerun (changed)
+        msg.debug (_("%s: changes in %s are not reported by LaTeX"),
+                   self.source (), ','.join (changed))
+        return None
+
+    def aux_writes (self):
+        """
+        The snapshots of the lines copied from each .aux file to other
+        files. A missing file copies nothing.
+        """
+        writes = []
+        for aux in self.aux_files:
+            snapshot = rubber.contents.snapshot (aux, 'aux-writes')
+            if snapshot == rubber.contents.NO_SUCH_FILE:
+                snapshot = rubber.contents.EMPTY
+            writes.append (snapshot)
+        return writes
+
     #--  Utility methods  {{{2
 
     def get_errors (self):
+        if self.failed_preflight:
+            return iter (self.missing)
         if self.failed_module is None:
             return self.log.get_errors()
         else:
@@ -11,16 +11,16 @@ import rubber.depend
 
 class LHSDep (rubber.depend.Pipe):
 
-    def __init__ (self, target, source):
-        super ().__init__ (('lhs2tex', '--poly', source), target)
+    def __init__ (self, graph, target, source):
+        super ().__init__ (graph, ('lhs2tex', '--poly', source), target)
         self.add_source (source)
 
 class CWebDep (rubber.depend.Shell):
 
-    def __init__ (self, target, source):
+    def __init__ (self, graph, target, source):
         assert target[-4:] == '.tex'
         base = target[:-4]
-        super ().__init__ (("cweave", source, target))
+        super ().__init__ (graph, ("cweave", source, target))
         self.add_product (target)
         self.add_product (base + ".idx")
         self.add_product (base + ".scn")
@@ -28,8 +28,8 @@ class CWebDep (rubber.depend.Shell):
 
 class KnitrDep (rubber.depend.Shell):
 
-    def __init__ (self, target, source):
-        super ().__init__ (('R', '-e', 'library(knitr); knit("%s")' % source))
+    def __init__ (self, graph, target, source):
+        super ().__init__ (graph, ('R', '-e', 'library(knitr); knit("%s")' % source))
         self.add_source (source)
         self.add_product (target)
 
@@ -17,8 +17,6 @@ from rubber.util import _, prog_available
 import rubber.depend
 import rubber.converters.latex
 
-metapost_logfile_limit = 1000000
-
 def check (source, target, context):
     return prog_available('mpost')
 
@@ -75,7 +73,7 @@ class MPLogCheck (rubber.converters.latex.LogCheck):
 
             log = rubber.converter.latex.LogCheck()
             # FIXME this path has no testcase.
-            if not log.readlog (os.path.join(self.pwd, "mpxerr.log"), metapost_logfile_limit):
+            if not log.readlog (os.path.join(self.pwd, "mpxerr.log")):
                 yield err
                 continue
 
@@ -86,7 +84,7 @@ class MPLogCheck (rubber.converters.latex.LogCheck):
 
             # get the name of the mpxNNN.tex source
 
-            for line in log.lines:
+            for line in log.iter_lines ():
                 if line[:2] == "**":
                     tex_src = os.path.join(".", line[2:].strip())
                     break
@@ -121,7 +119,7 @@ class Dep (rubber.depend.Node):
     """
     def __init__ (self, env, target, source):
         self.cmd_pwd = os.path.dirname(source)
-        super ().__init__ ()
+        super ().__init__ (env.graph)
         self.add_product (target)
         self.include (os.path.basename (source))
         msg.debug (_("%s is made from %s"), target, " ".join (self.sources))
@@ -154,6 +152,9 @@ class Dep (rubber.depend.Node):
                 if m:
                     self.include (m.group ("file"))
 
+    def signature (self):
+        return self.cmd
+
     def run (self):
         """
         Run Metapost from the source file's directory, so that figures are put
@@ -166,7 +167,7 @@ class Dep (rubber.depend.Node):
         # This creates a log file that has the same aspect as TeX logs.
 
         self.log = MPLogCheck(self.cmd_pwd)
-        if not self.log.readlog (self.base + ".log", metapost_logfile_limit):
+        if not self.log.readlog (self.base + ".log"):
             msg.error(_(
                 "I can't read MetaPost's log file, this is wrong."))
             return False
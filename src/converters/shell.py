@@ -18,7 +18,7 @@ def check (source, target, context):
     return prog_available(line[0])
 
 def convert (source, target, context, env):
-    result = Shell (parse_line (context ['command'], context))
+    result = Shell (env.graph, parse_line (context ['command'], context))
     result.add_product (target)
     result.add_source (source)
     return result
@@ -3,11 +3,16 @@ This module contains code for handling dependency graphs.
 """
 # vim: noet:ts=4
 
+import concurrent.futures
 import logging
 msg = logging.getLogger (__name__)
 import os.path
 import subprocess
+import tempfile
+import threading
 import rubber.contents
+import rubber.listing
+import rubber.trace
 from rubber.util import _
 
 class MakeError (Exception):
@@ -16,60 +21,261 @@ class MakeError (Exception):
         self.msg    = msg
         self.errors = errors
 
-# Dictionnary allowing to find a Node by one of its products.
-# It should not be used outside this module.
-_producer = {}
-
-def clean_all_products ():
-    """Clean all products of all recipes."""
-    for path in _producer:
-        if os.path.exists (path):
-            msg.info (_("removing %s"), path)
-            os.remove (path)
-
-def save_cache (cache_path, final):
-    msg.debug (_('Creating or overwriting cache file %s') % cache_path)
-    with open (cache_path, 'tw') as f:
-        for node in final.all_producers ():
-            if node.snapshots is not None:
-                f.write (node.primary_product ())
-                f.write ('\n')
-                for i in range (len (node.sources)):
-                    f.write ('  ')
-                    f.write (rubber.contents.cs2str (node.snapshots [i]))
-                    f.write (' ')
-                    f.write (node.sources [i])
-                    f.write ('\n')
+# Set in the worker threads of make_parallel, where the sources of the
+# node being made have already been made by the scheduler.
+_scheduled = threading.local ()
+
+# The first line of a cache file, updated when the format changes.
+cache_header = 'rubber cache, format 4\n'
 
-def load_cache (cache_path):
-    msg.debug (_('Reading external cache file %s') % cache_path)
-    with open (cache_path) as f:
+class Graph:
+    """
+    The recipes of a build, indexed by their products. Each Environment
+    owns one, so that several documents may be compiled in the same
+    process without sharing state.
+    """
+    def __init__ (self):
+        # Dictionnary allowing to find a Node by one of its products.
+        # It should not be used outside this module.
+        self.producer = {}
+        # Maximal number of recipes run at the same time (-j option).
+        self.jobs = 1
+        # A summary of the options the graph was built with, see
+        # up_to_date.
+        self.signature = ''
+
+    def clean_all_products (self):
+        """Clean all products of all recipes."""
+        for path in self.producer:
+            if os.path.exists (path):
+                msg.info (_("removing %s"), path)
+                os.remove (path)
+
+    def save_cache (self, cache_path, final):
+        """
+        Write the checksums of the sources of all recipes to cache_path,
+        with the fingerprints of the files watched by rubber.contents and
+        the state of the leaves and primary products for up_to_date.
+        The caller is expected to hold a lock on cache_path + '.lock',
+        see rubber.util.lock_file. The file is replaced atomically, so
+        that a crash leaves either the old or the new version.
+        """
+        msg.debug (_('Creating or overwriting cache file %s') % cache_path)
+        state = [('product', node.primary_product ())
+                 for node in final.all_producers ()]
+        state.extend (('leaf', path) for path in sorted (final.all_leaves ()))
+        state = [(kind, rubber.contents.snapshot (path), path)
+                 for kind, path in state]
+        directory, name = os.path.split (cache_path)
+        with tempfile.NamedTemporaryFile (mode='tw', dir=directory or '.',
+                                          prefix=name + '.', delete=False) as f:
+            try:
+                f.write (cache_header)
+                f.write ('signature %s\n' % self.signature)
+                for path, strategy, checksum, fprint in rubber.contents.save ():
+                    f.write ('checksum ')
+                    f.write (rubber.contents.cs2str (checksum))
+                    f.write (' %i %i %i %s ' % (fprint + (strategy,)))
+                    f.write (path)
+                    f.write ('\n')
+                for kind, checksum, path in state:
+                    f.write ('%s %s %s\n' % (kind,
+                        rubber.contents.cs2str (checksum), path))
+                for node in final.all_producers ():
+                    if node.snapshots is not None:
+                        f.write ('recipe ')
+                        f.write (node.primary_product ())
+                        f.write ('\n')
+                        for i in range (len (node.sources)):
+                            f.write ('  ')
+                            f.write (rubber.contents.cs2str (node.snapshots [i]))
+                            f.write (' ')
+                            f.write (node.sources [i])
+                            f.write ('\n')
+            except:
+                os.remove (f.name)
+                raise
+        os.replace (f.name, cache_path)
+
+    def read_checksums (self, f):
+        """
+        Read the header and the checksums of an open cache file, giving
+        the fingerprints to rubber.contents. Return the signature and
+        the first line after the checksums, or None for an unknown format.
+        """
+        written = os.fstat (f.fileno ()).st_mtime_ns
+        line = f.readline ()
+        if line != cache_header:
+            if line:
+                msg.debug (_('%s: unknown format, ignored'), f.name)
+            return None
+        signature = f.readline () [10:-1]
+        limit = rubber.contents.cs_str_len
         line = f.readline ()
-        while line:
-            product = line [:-1]
-            sources = []
-            snapshots = []
-            while True:
+        while line.startswith ('checksum '):
+            checksum = rubber.contents.str2cs (line [9:9 + limit])
+            size, mtime, inode, strategy, path = \
+                line [10 + limit:-1].split (' ', 4)
+            rubber.contents.load (path, strategy, checksum,
+                                  (int (size), int (mtime), int (inode)),
+                                  written)
+            line = f.readline ()
+        return signature, line
+
+    def up_to_date (self, cache_path):
+        """
+        Tell whether the last build recorded in cache_path is still valid,
+        without parsing the sources: it was made with the same signature,
+        and none of the leaves of the graph and primary products of its
+        recipes changed since. The leaves include all parsed sources, so
+        the graph itself would be the same.
+        """
+        try:
+            f = open (cache_path)
+        except FileNotFoundError:
+            return False
+        with f:
+            header = self.read_checksums (f)
+            if header is None:
+                return False
+            signature, line = header
+            if signature != self.signature:
+                msg.debug (_('%s: built with other options'), cache_path)
+                return False
+            limit = rubber.contents.cs_str_len
+            found = False
+            while line.startswith (('leaf ', 'product ')):
+                start = line.index (' ') + 1
+                checksum = rubber.contents.str2cs (line [start:start + limit])
+                path = line [start + limit + 1:-1]
+                if rubber.contents.snapshot (path) != checksum:
+                    msg.debug (_('%s: changed since the last build'), path)
+                    return False
+                found = True
+                line = f.readline ()
+        return found
+
+    def load_cache (self, cache_path):
+        msg.debug (_('Reading external cache file %s') % cache_path)
+        with open (cache_path) as f:
+            header = self.read_checksums (f)
+            if header is None:
+                return
+            limit = rubber.contents.cs_str_len
+            line = header [1]
+            while line.startswith (('leaf ', 'product ')):
                 line = f.readline ()
-                if not line.startswith ('  '): # Including end of file.
+            while line.startswith ('recipe '):
+                product = line [7:-1]
+                sources = []
+                snapshots = []
+                while True:
+                    line = f.readline ()
+                    if not line.startswith ('  '): # Including end of file.
+                        break
+                    snapshots.append (rubber.contents.str2cs (line [2:2 + limit]))
+                    sources.append (line [3 + limit:-1])
+                try:
+                    node = self.producer [product]
+                except KeyError:
+                    msg.debug (_('%s: no such recipe anymore') % product)
+                else:
+                  if node.sources != sources:
+                    msg.debug (_('%s: depends on %s not anymore on %s'), product,
+                        " ".join (node.sources), " ".join (sources))
+                  elif node.snapshots is not None:
+                    # FIXME: this should not happen. See cweb-latex test.
+                    msg.debug (_('%s: rebuilt before cache read'), product)
+                  else:
+                    msg.debug (_('%s: using cached checksums'), product)
+                    node.snapshots = snapshots
+
+def make_parallel (node):
+    """
+    Make all the recipes the sources of 'node' depend on, running up to
+    'jobs' of them at the same time. A recipe is started once all the
+    recipes producing its sources have finished. Nodes being made (the
+    callers of this function) are left out, and so are the edges closing
+    a cycle, exactly like Node.make prunes them. Serial nodes are made
+    in the calling thread while no other recipe runs.
+    Returns True when something was recompiled.
+    MakeError is raised in case of error, once all running recipes
+    have finished.
+    """
+    children = {}
+    def visit (parent, stack):
+        deps = children [parent] = []
+        stack.add (parent)
+        for source in parent.sources:
+            dep = node.graph.producer.get (source)
+            if dep is None or dep.making or dep in stack or dep in deps:
+                continue
+            if dep not in children:
+                visit (dep, stack)
+            deps.append (dep)
+        stack.remove (parent)
+    visit (node, set ())
+    del children [node]
+    if not children:
+        return False
+
+    waiting = {}
+    parents = {}
+    for child, deps in children.items ():
+        waiting [child] = set (deps)
+        for dep in deps:
+            parents.setdefault (dep, []).append (child)
+    ready = [child for child, deps in waiting.items () if not deps]
+
+    def finished (child):
+        for parent in parents.get (child, ()):
+            waiting [parent].remove (child)
+            if not waiting [parent]:
+                ready.append (parent)
+
+    rv = False
+    error = None
+    running = {}
+    jobs = node.graph.jobs
+    with concurrent.futures.ThreadPoolExecutor (max_workers=jobs) as pool:
+        while error is None:
+            for child in [child for child in ready if not child.serial]:
+                ready.remove (child)
+                msg.debug (_("%s: needs %s, making it in parallel"),
+                           node.primary_product (), child.primary_product ())
+                running [pool.submit (_make_scheduled, child)] = child
+            if not running:
+                if not ready:
                     break
-                limit = 2 + rubber.contents.cs_str_len
-                snapshots.append (rubber.contents.str2cs (line [2:limit]))
-                sources.append (line [limit + 1:-1])
-            try:
-                node = _producer [product]
-            except KeyError:
-                msg.debug (_('%s: no such recipe anymore') % product)
-            else:
-              if node.sources != sources:
-                msg.debug (_('%s: depends on %s not anymore on %s'), product,
-                    " ".join (node.sources), " ".join (sources))
-              elif node.snapshots is not None:
-                # FIXME: this should not happen. See cweb-latex test.
-                msg.debug (_('%s: rebuilt before cache read'), product)
-              else:
-                msg.debug (_('%s: using cached checksums'), product)
-                node.snapshots = snapshots
+                child = ready.pop (0)
+                try:
+                    rv = _make_scheduled (child) or rv
+                except Exception as e:
+                    error = e
+                else:
+                    finished (child)
+                continue
+            done, _ignored = concurrent.futures.wait (
+                running, return_when=concurrent.futures.FIRST_COMPLETED)
+            for future in done:
+                child = running.pop (future)
+                try:
+                    rv = future.result () or rv
+                except Exception as e:
+                    if error is None:
+                        error = e
+                else:
+                    finished (child)
+    if error is not None:
+        raise error
+    return rv
+
+def _make_scheduled (node):
+    _scheduled.active = True
+    try:
+        return node.make ()
+    finally:
+        _scheduled.active = False
 
 class Node (object):
     """
@@ -77,12 +283,22 @@ class Node (object):
     functionality of date checking and recursive making, supposing the
     existence of a method `run()' in the object.
     """
-    def __init__ (self):
+    # Set to True by recipes that must never run at the same time as
+    # another recipe, for example because they temporarily move files
+    # shared with other nodes.
+    serial = False
+
+    # How many times make() may run the recipe while its sources keep
+    # changing. Documents may raise it for LaTeXDep (see 'set').
+    max_attempts = 5
+
+    def __init__ (self, graph):
         """
-        The node registers itself in the dependency set,
+        The node registers itself in the dependency graph,
         and if a given depedency is not known in the set, a leaf node is made
         for it.
         """
+        self.graph = graph
         self.product = None
         # All prerequisites for this recipe.
         self.sources = []
@@ -93,6 +309,9 @@ class Node (object):
         self.snapshots = None
         # making is the lock guarding against making a node while making it
         self.making = False
+        # The rubber.artifacts.Store where the products are archived, if
+        # any. Only used when the node has a signature.
+        self.artifacts = None
 
     def all_producers (self):
         def rec (node):
@@ -102,13 +321,13 @@ class Node (object):
                     yield node
                     for source in node.sources:
                         try:
-                            child = _producer [source]
+                            child = self.graph.producer [source]
                         except KeyError:
                             pass
                         else:
                             yield from rec (child)
                 finally:
-                    self.making = False
+                    node.making = False
         yield from rec (self)
 
     def all_leaves (self):
@@ -120,12 +339,12 @@ class Node (object):
                 node.making = True
                 try:
                     for source in node.sources:
-                        if source in _producer:
-                            rec (_producer [source])
+                        if source in self.graph.producer:
+                            rec (self.graph.producer [source])
                         else:
                             result.add (source)
                 finally:
-                    self.making = False
+                    node.making = False
         rec (self)
         return result
 
@@ -151,14 +370,14 @@ class Node (object):
         """An iterable with all all products for this recipe.
         This function is not efficient, but called only once by
         cmdline.py with a specific command-line option."""
-        return (key for key, value in _producer.items () if value is self)
+        return (key for key, value in self.graph.producer.items () if value is self)
 
     def add_product (self, name):
         """
         Register a new product for this node.
         """
-        # TODO: why does this break? assert name not in _producer, name
-        _producer [name] = self
+        # TODO: why does this break? assert name not in self.graph.producer, name
+        self.graph.producer [name] = self
         if self.product is None:
             self.product = name
 
@@ -167,10 +386,10 @@ class Node (object):
 
     def replace_product (self, name):
         """Trick for latex.py"""
-        # TODO: why does this break? assert name not in _producer, name
-        del _producer [self.product]
+        # TODO: why does this break? assert name not in self.graph.producer, name
+        del self.graph.producer [self.product]
         self.product = name
-        _producer [name] = self
+        self.graph.producer [name] = self
 
     def make (self):
         """
@@ -182,7 +401,8 @@ class Node (object):
         MakeError is raised in case of error.
         """
         # The recurrence is similar to all_producers, except that we
-        # try each compilations a few times.
+        # try each compilations a few times, and stop as soon as the
+        # sources return to a state already seen during this call.
 
         pp = self.primary_product ()
 
@@ -192,26 +412,40 @@ class Node (object):
 
         rv = False
         self.making = True
+        # The snapshots of the sources for each run of the recipe.
+        history = []
+        # Whether the loop stopped because a source is missing.
+        pruned = False
         try:
-            for patience in range (5):
+            for patience in range (self.max_attempts + 1):
                 msg.debug (_('%s: made from %s   attempt %i'),
                            self.product, ','.join (self.sources),
                            patience)
 
-                # make our sources
-                for source in self.sources:
-                    try:
-                        dep = _producer [source]
-                    except KeyError:
-                        msg.debug (_("%s: needs %s, leaf"), pp, source)
-                    else:
-                        msg.debug (_("%s: needs %s, making %s"), pp, source,
-                                   dep.primary_product ())
-                        rv = dep.make () or rv
+                # make our sources, the independent ones concurrently
+                # if requested, then check them all in order.
+                parallel = 1 < self.graph.jobs \
+                    and not getattr (_scheduled, 'active', False)
+                if parallel:
+                    rv = make_parallel (self) or rv
+                    _scheduled.active = True
+                try:
+                    for source in self.sources:
+                        try:
+                            dep = self.graph.producer [source]
+                        except KeyError:
+                            msg.debug (_("%s: needs %s, leaf"), pp, source)
+                        else:
+                            msg.debug (_("%s: needs %s, making %s"), pp, source,
+                                       dep.primary_product ())
+                            rv = dep.make () or rv
+                finally:
+                    if parallel:
+                        _scheduled.active = False
 
                 # Once all dependent recipes have been run, check the
                 # state of the sources on disk.
-                snapshots = tuple (map (rubber.contents.snapshot, self.sources))
+                snapshots = tuple (map (self.snapshot, self.sources))
 
                 missing = ','.join (
                     self.sources [i] for i in range (len (snapshots))
@@ -223,32 +457,78 @@ class Node (object):
                         msg.debug (_("%s: missing %s, but first LaTeX run"), pp, missing)
                     else:
                         msg.debug (_("%s: missing %s, pruning"), pp, missing)
-                        return rv
+                        pruned = True
+                        break
 
                 if self.snapshots is None:
                     msg.debug (_("%s: first attempt or --force, building"), pp)
+                    reason = 'first attempt or --force'
                 else:
                     # There has already been a successful build.
-                    changed = ','.join (
-                        self.sources [i] for i in range (len (snapshots))
-                        if self.snapshots [i] != snapshots [i])
-                    if not changed:
-                        msg.debug (_("%s: sources unchanged since last build"), pp)
-                        return rv
-                    msg.debug (_("%s: some sources changed: %s"), pp, changed)
-
-                if not self.run ():
-                    raise MakeError (_("Recipe for {} failed").format (pp),
-                                     self.get_errors ())
+                    changed = [self.sources [i] for i in range (len (snapshots))
+                               if self.snapshots [i] != snapshots [i]]
+                    if changed:
+                        msg.debug (_("%s: some sources changed: %s"), pp,
+                                   ','.join (changed))
+                    if history:
+                        # The recipe has just run and may know better.
+                        reason = self.rerun (changed)
+                    elif changed:
+                        reason = 'changed: ' + ','.join (changed)
+                    elif patience == 0 and not os.path.exists (pp):
+                        msg.debug (_("%s: removed since last build"), pp)
+                        reason = 'removed'
+                    else:
+                        reason = None
+                    if reason is None:
+                        if changed:
+                            msg.debug (_("%s: changes need no new run"), pp)
+                        else:
+                            msg.debug (_("%s: sources unchanged since last build"), pp)
+                        break
+                    if changed and snapshots in history:
+                        # Running again would only repeat an earlier
+                        # attempt, and so on forever.
+                        raise MakeError (
+                            _("Contents of {} oscillate between runs: {}")
+                            .format (pp, ','.join (changed)),
+                            self.get_errors ())
+                    if not changed and patience == self.max_attempts:
+                        msg.warning (_("%s: giving up after %d attempts (%s)"),
+                                     pp, self.max_attempts, reason)
+                        break
+
+                if patience == self.max_attempts:
+                    # The last attempt only checks the sources.
+                    raise MakeError (
+                        _("Contents of {} do not settle after {} attempts")
+                        .format (pp, self.max_attempts), self.get_errors ())
+
+                with rubber.trace.span (pp, type (self).__name__,
+                                        product=pp, attempt=patience,
+                                        reason=reason):
+                    succeeded = self.run_cached (snapshots)
+                    # The recipe may have written files.
+                    rubber.listing.invalidate ()
+                    if not succeeded:
+                        raise MakeError (_("Recipe for {} failed").format (pp),
+                                         self.get_errors ())
 
                 # Build was successful.
                 self.snapshots = snapshots
+                history.append (snapshots)
                 rv = True
 
-            # Patience exhausted.
-            raise MakeError (_("Contents of {} do not settle").format (pp),
-                             self.get_errors ())
-
+            # Only complete a recipe whose last run is still valid.
+            if history and not pruned:
+                with rubber.trace.span (pp, type (self).__name__,
+                                        product=pp, reason='finish'):
+                    succeeded = self.finish ()
+                    rubber.listing.invalidate ()
+                    if not succeeded:
+                        raise MakeError (_("Recipe for {} failed").format (pp),
+                                         self.get_errors ())
+            return rv
         finally:
             self.making = False
 
@@ -260,6 +540,64 @@ class Node (object):
         """
         return False
 
+    def finish (self):
+        """
+        Called by make when the sources are stable after one or more runs
+        of the recipe, for recipes that need a last step then. Return
+        False on failure. The default does nothing.
+        """
+        return True
+
+    def rerun (self, changed):
+        """
+        Called by make after a run of the recipe, with the list of the
+        sources whose snapshots changed since the previous run. Return
+        a short reason to run the recipe again, or None. Recipes whose
+        tools report what they need may override this to ignore some
+        changes, or to run again without any.
+        """
+        if changed:
+            return 'changed: ' + ','.join (changed)
+        return None
+
+    def snapshot (self, source):
+        """
+        The snapshot of a source deciding whether the recipe must run
+        again. Nodes only reading a part of a source may override this
+        to use a more specific strategy, see rubber.contents.register.
+        """
+        return rubber.contents.snapshot (source)
+
+    def signature (self):
+        """
+        Describe how the products are made from the sources, as a
+        sequence of strings (typically a command line). If the products
+        only depend on the contents of the sources and on the signature,
+        they may be restored from an artifact cache instead of being
+        rebuilt. The default None means that they depend on more.
+        """
+        return None
+
+    def run_cached (self, snapshots):
+        """
+        Restore the products from the artifact cache if possible, else
+        call run and store the products in the cache. The snapshots are
+        those of the sources on which the build is based.
+        """
+        if self.artifacts is None or self.signature () is None:
+            return self.run ()
+        products = sorted (self.products ())
+        key = self.artifacts.key (self, snapshots, products)
+        if self.artifacts.restore (key, products):
+            msg.info (_("restored %s from the artifact cache"),
+                      ', '.join (products))
+            return True
+        if not self.run ():
+            return False
+        if all (map (os.path.exists, products)):
+            self.artifacts.save (key, products)
+        return True
+
     def get_errors (self):
         """
         Report the errors that caused the failure of the last call to run, as
@@ -278,17 +616,23 @@ class Shell (Node):
     """
     This class specializes Node for generating files using shell commands.
     """
-    def __init__ (self, command):
-        super ().__init__ ()
+    def __init__ (self, graph, command):
+        super ().__init__ (graph)
         self.command = command
         self.stdout = None
 
+    def signature (self):
+        return self.command
+
     def run (self):
         msg.info(_("running: %s") % ' '.join(self.command))
-        process = subprocess.Popen (self.command,
-            stdin=subprocess.DEVNULL,
-            stdout=self.stdout)
-        if process.wait() != 0:
+        with rubber.trace.span (self.command [0], 'process',
+                                argv=list (self.command)):
+            process = subprocess.Popen (self.command,
+                stdin=subprocess.DEVNULL,
+                stdout=self.stdout)
+            ret = process.wait ()
+        if ret != 0:
             msg.error(_("execution of %s failed") % self.command[0])
             return False
         return True
@@ -298,8 +642,8 @@ class Pipe (Shell):
     This class specializes Node for generating files using the stdout of shell commands.
     The 'product' will receive the stdout of 'command'.
     """
-    def __init__ (self, command, product):
-        super ().__init__ (command)
+    def __init__ (self, graph, command, product):
+        super ().__init__ (graph, command)
         self.add_product (product)
 
     def run (self):
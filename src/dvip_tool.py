@@ -27,7 +27,7 @@ product_extension = { 'dvips':'ps', 'dvipdfm':'pdf' }
 class Dvip_Tool_Dep_Node (rubber.depend.Node):
 
     def __init__ (self, document, tool):
-        super ().__init__ ()
+        super ().__init__ (document.env.graph)
         self.tool = tool
         assert tool in ('dvipdfm', 'dvips')
         self.doc = document
@@ -14,6 +14,8 @@ from rubber.util import _
 import logging
 msg = logging.getLogger (__name__)
 import rubber.converters
+import rubber.depend
+import rubber.listing
 from rubber.convert import Converter
 
 class Environment:
@@ -28,12 +30,20 @@ class Environment:
         working directory.
         """
         self.path = [os.path.curdir]
+        # A new build may follow changes made by another one.
+        rubber.listing.invalidate ()
+        self.graph = rubber.depend.Graph ()
         self.conv_prefs = {}
         self.converter = Converter (self)
         self.converter.read_ini (os.path.join (rubber.__path__[0], 'rules.ini'))
 
         self.doc_requires_shell_ = False
         self.synctex = False
+        # A rubber.artifacts.Store for the products of conversions, or None.
+        self.artifacts = None
+        # The directory where LaTeX and the tools processing its auxiliary
+        # files write, or None for the current directory.
+        self.build_dir = None
         self.main = None
         self.final = None
         self.graphics_suffixes = []
@@ -46,9 +56,9 @@ class Environment:
         """
         for path in self.path:
             test = os.path.join(path, name)
-            if suffix and os.path.exists(test + suffix) and os.path.isfile(test + suffix):
+            if suffix and rubber.listing.isfile (test + suffix):
                 return test + suffix
-            elif os.path.exists(test) and os.path.isfile(test):
+            elif rubber.listing.isfile (test):
                 return test
         return None
 
@@ -102,7 +112,7 @@ class Environment:
 
             # Check if the target exists.
 
-            if prefs is None and os.path.exists(t):
+            if prefs is None and rubber.listing.exists (t):
                 if last is not None and last["cost"] <= 0:
                     break
                 msg.debug(_("`%s' is `%s', no rule applied") % (target, t))
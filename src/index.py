@@ -6,6 +6,7 @@ Common support for makeindex and xindy external tools.
 """
 import logging
 msg = logging.getLogger (__name__)
+import os
 import rubber.depend
 from rubber.util import _
 
@@ -22,7 +23,7 @@ class Index (rubber.depend.Node):
         LaTeX), the target file (the output of makeindex) and the transcript
         (e.g. .ilg) file.  Transcript is used by glosstex.py.
         """
-        super ().__init__ ()
+        super ().__init__ (doc.env.graph)
         src = doc.basename (with_suffix = "." + source)
         tgt = doc.basename (with_suffix = "." + target)
         log = doc.basename (with_suffix = "." + transcript)
@@ -32,6 +33,11 @@ class Index (rubber.depend.Node):
         self.add_source (src)
         doc.add_source (tgt)
         self.doc = doc
+        # The tool runs in the build directory if any, like BibTeX.
+        self.directory = doc.env.build_dir
+        if self.directory is not None:
+            src, tgt, log = (os.path.relpath (path, self.directory)
+                             for path in (src, tgt, log))
         self.cmd = ["makeindex", src, "-q", "-o", tgt, "-t", log]
         self.lang = None   # only for xindy
         self.modules = []  # only for xindy
@@ -105,10 +111,15 @@ class Index (rubber.depend.Node):
                     self.cmd.append (self.lang)
                 path_var = "XINDY_SEARCHPATH"
 
-            if self.path != []:
-                self.command_env = { path_var: ':'.join(self.path + [os.getenv(path_var, '')]) }
+            path = self.path
+            if self.directory is not None:
+                cwd = os.getcwd ()
+                path = [cwd] + [os.path.join (cwd, p) for p in path]
+            if path != []:
+                self.command_env = { path_var: ':'.join(path + [os.getenv(path_var, '')]) }
             else:
                 self.command_env = {}
 
         # The actual run.
-        return rubber.util.execute (self.cmd, env=self.command_env) == 0
+        return rubber.util.execute (self.cmd, env=self.command_env,
+                                    pwd=self.directory) == 0
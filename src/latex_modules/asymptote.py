@@ -30,9 +30,15 @@ options, only the former is recognized.
 
 Asymptote insists on replacing the main .aux file with an empty one,
 so we backup its content before running the external tool.
+
+LaTeX rewrites all .asy files on each compilation, but a figure is only
+made again when the contents of its file change. When one figure must
+be made, all others in the same situation are made by the same run of
+'asy', so that the tool is started and the .aux file moved only once.
 """
 
 import os
+import rubber.contents
 import rubber.depend
 import rubber.module_interface
 import rubber.util
@@ -67,6 +73,8 @@ class Module (rubber.module_interface.Module):
 
         self.global_inline = inline_option (opt, default=False)
 
+        self.batch = Batch (document.basename (with_suffix = '.aux'))
+
         document.hook_begin ("asy", self.on_begin_asy)
 
     def on_begin_asy (self, loc):
@@ -84,8 +92,8 @@ class Module (rubber.module_interface.Module):
         inline = inline_option (environment_options, default=self.global_inline)
 
         self.doc.add_product (source)
-        node = Shell_Restoring_Aux (self.doc.basename (with_suffix = '.aux'),
-                                    source)
+        node = Figure (self.doc.env.graph, self.batch, source)
+        node.artifacts = self.doc.env.artifacts
         if inline:
             node.add_product (prefix + ".tex")
             node.add_product (prefix + "_0" + self.format)
@@ -96,22 +104,116 @@ class Module (rubber.module_interface.Module):
             self.doc.add_source (prefix + self.format)
         node.add_source (source)
 
-class Shell_Restoring_Aux (rubber.depend.Shell):
-    """This class replaces Shell because of a bug in asymptote. Every run
-of /usr/bin/asy flushes the .aux file.
-
+class Batch:
+    """
+    The figures of a document, made together by a single run of asy.
+    This run must not happen while another recipe runs, because it moves
+    the main .aux file away.
     """
 
-    def __init__ (self, aux, source):
-        super ().__init__ (command = ('asy', source))
+    def __init__ (self, aux):
         self.aux = aux
+        self.figures = []
+        # Figure -> snapshot of its source when it was made by this batch.
+        self.made = {}
+
+    def outdated (self, figure, snapshot):
+        """
+        Whether the figure must be made from a source with this snapshot.
+        """
+        if snapshot == rubber.contents.NO_SUCH_FILE:
+            # LaTeX has not written it yet.
+            return False
+        if self.made.get (figure) == snapshot:
+            return False
+        return figure.snapshots is None or figure.snapshots [0] != snapshot \
+            or not all (map (os.path.exists, figure.outputs))
+
+    def make (self, figure):
+        """
+        Make the given figure and all others that are out of date, unless
+        it was already made from its current source. Return False on
+        failure.
+        """
+        snapshot = rubber.contents.snapshot (figure.source)
+        if self.made.get (figure) == snapshot:
+            return True
+        todo = {figure: snapshot}
+        for other in self.figures:
+            if other is not figure:
+                snapshot = rubber.contents.snapshot (other.source)
+                if self.outdated (other, snapshot) \
+                   and not other.restore (snapshot):
+                    todo [other] = snapshot
 
-    def run (self):
         bak = self.aux + '.away_from_asymptote'
         msg.debug (_("saving %s to %s"), self.aux, bak)
         os.rename (self.aux, bak)
         try:
-            return super ().run ()
+            command = ['asy'] + [other.source for other in todo]
+            if rubber.util.execute (command) != 0:
+                msg.error (_("execution of %s failed") % 'asy')
+                return False
         finally:
             msg.debug (_("restoring %s to %s"), bak, self.aux)
             os.rename (bak, self.aux)
+
+        for other, snapshot in todo.items ():
+            self.made [other] = snapshot
+            if other is not figure:
+                other.save (snapshot)
+        return True
+
+class Figure (rubber.depend.Shell):
+    """
+    The output of asy for one environment, made by the batch of its
+    document.
+    """
+
+    # Moving the .aux file away must not happen while another recipe runs.
+    serial = True
+
+    def __init__ (self, graph, batch, source):
+        super ().__init__ (graph, command = ('asy', source))
+        self.batch = batch
+        self.source = source
+        self.outputs = []
+        batch.figures.append (self)
+
+    def add_product (self, name):
+        super ().add_product (name)
+        self.outputs.append (name)
+
+    def run_cached (self, snapshots):
+        if self.batch.made.get (self) == snapshots [0]:
+            # Already made or restored along with another figure.
+            return True
+        return super ().run_cached (snapshots)
+
+    def run (self):
+        return self.batch.make (self)
+
+    def restore (self, snapshot):
+        """
+        Restore the products made from a source with this snapshot from
+        the artifact cache, when the batch makes the figure before its
+        own turn. Return False if they are not there.
+        """
+        if self.artifacts is None:
+            return False
+        products = sorted (self.outputs)
+        key = self.artifacts.key (self, (snapshot,), products)
+        if not self.artifacts.restore (key, products):
+            return False
+        msg.info (_("restored %s from the artifact cache"), ', '.join (products))
+        self.batch.made [self] = snapshot
+        return True
+
+    def save (self, snapshot):
+        """Archive the products made by the batch, see restore."""
+        if self.artifacts is None:
+            return
+        products = sorted (self.outputs)
+        if all (map (os.path.exists, products)):
+            self.artifacts.save (self.artifacts.key (self, (snapshot,), products),
+                                 products)
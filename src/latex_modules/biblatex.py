@@ -43,7 +43,7 @@ biber_to_rubber = { "ERROR": "error",
 class BibLaTeXDep (rubber.biblio.BibToolDep):
 
     def __init__ (self, doc, tool):
-        super ().__init__ ()
+        super ().__init__ (doc.env.graph)
         self.doc = doc
         self.tool = tool
         self.blg = doc.basename (with_suffix = ".blg")
@@ -55,18 +55,26 @@ class BibLaTeXDep (rubber.biblio.BibToolDep):
             for macro in ("addbibresource", "addglobalbib", "addsectionbib"):
                 doc.hook_macro (macro, "oa", self.add_bib_resource)
             self.source = doc.basename (with_suffix = ".bcf")
+            self.strategy = 'biber'
             doc.add_product (self.source)
         else:
             self.source = doc.basename (with_suffix = ".aux")
             doc.add_product (doc.basename (with_suffix = "-blx.bib"))
 
         self.add_source (self.source)
+        self.citations = self.source
+        self.directory = doc.env.build_dir
         doc.add_source (doc.basename (with_suffix = ".bbl"))
 
     def build_command (self):
-        return [ self.tool, self.source ]
-
-    def add_bib_resource (self, doc, opt, name):
+        if self.pruner is not None and self.tool == "biber":
+            # The copy of the control file refers to the pruned
+            # databases, the results are expected here.
+            return [ self.tool, "--output-directory", ".",
+                     self.tool_path (self.pruner.bcf) ]
+        return [ self.tool, self.tool_path (self.source) ]
+
+    def add_bib_resource (self, loc, opt, name):
         msg.debug (_("bibliography resource discovered: %s") % name)
         options = rubber.util.parse_keyval (opt)
 
@@ -81,13 +89,15 @@ class BibLaTeXDep (rubber.biblio.BibToolDep):
 
         filename = self.find_bib (name)
         if filename is None:
-            msg.error (_("cannot find bibliography resource %s") % name)
+            text = _("cannot find bibliography resource %s") % name
+            msg.error (text)
+            self.doc.add_missing (loc, text)
         else:
-            self.add_source (filename)
+            self.add_database (name, filename)
 
-    def add_bibliography (self, doc, names):
+    def add_bibliography (self, loc, names):
         for bib in names.split (","):
-            self.add_bib_resource (doc, None, bib.strip ())
+            self.add_bib_resource (loc, None, bib.strip ())
 
     def bibliographystyle (self, loc, bibs):
         msg.warning (_("\\usepackage{biblatex} incompatible with \\bibliographystyle"))
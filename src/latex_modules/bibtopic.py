@@ -45,8 +45,8 @@ class Module (rubber.module_interface.Module):
         document.hook_macro ('bibliography', 'a', self.hook_bibliography)
         document.hook_macro ('bibliographystyle', 'a', self.hook_bibliographystyle)
 
-        document.add_product ('btaux.aux')
-        document.add_product ('btbbl.aux')
+        document.add_product (document.output_file ('btaux.aux'))
+        document.add_product (document.output_file ('btbbl.aux'))
 
     def on_begin_btsect (self, loc):
         self.btsect_environments += 1
@@ -10,7 +10,12 @@ class Module (rubber.module_interface.Module):
         document.add_product (job + '.ist')
         document.add_source (glo)
 
-        dep = rubber.depend.Shell (('makeglossaries', job))
+        if document.env.build_dir is None:
+            command = ('makeglossaries', job)
+        else:
+            command = ('makeglossaries', '-d', document.env.build_dir,
+                       document.vars ['job'])
+        dep = rubber.depend.Shell (document.env.graph, command)
         # FIXME: does probably fail with --inplace and friends.
         dep.add_product (glo)
         dep.add_product (job + '.gls')
@@ -17,11 +17,14 @@ incomplete, because \\includegraphics can have a complex format.
 
 import os, os.path
 import re
+import shutil
 import logging
 msg = logging.getLogger (__name__)
 import rubber.depend
+import rubber.listing
+import rubber.util
 from rubber.util import _
-from rubber.util import parse_keyval
+from rubber.util import parse_keyval, prog_available
 from rubber.tex import parse_string
 import rubber.module_interface
 
@@ -51,6 +54,79 @@ drv_suffixes = {
               ".eps", ".ps", ".mps", ".emf", ".wmf"]
 }
 
+# In draft graphics mode, the bitmaps with these suffixes that are larger
+# than proxy_threshold bytes are replaced by copies at most proxy_pixels
+# wide and high, compressed with the given quality.
+
+proxy_suffixes = [".jpg", ".jpeg", ".png"]
+proxy_threshold = 256 * 1024
+proxy_pixels = 1024
+proxy_quality = 60
+
+class Proxy (rubber.depend.Node):
+    """
+    A reduced copy of a bitmap, made with ImageMagick. Its resolution is
+    reduced along with its size in pixels, so that it takes as much room
+    on the page as the original.
+    """
+    def __init__ (self, graph, source, target):
+        super ().__init__ (graph)
+        self.source = source
+        self.target = target
+        self.add_product (target)
+        self.add_source (source)
+
+    def signature (self):
+        return ("draft-graphics", str (proxy_pixels), str (proxy_quality))
+
+    def geometry (self):
+        """
+        Return the size of the source in pixels and its resolution in dots
+        per inch, as a tuple (width, height, xres, yres), or None.
+        """
+        lines = []
+        rubber.util.execute (["identify", "-format", "%w %h %x %y %U\n",
+                              self.source + "[0]"], out=lines.append)
+        if not lines:
+            return None
+        # Older versions print the unit after each resolution.
+        m = re.match (rb"(\d+) (\d+) ([0-9.]+)(?: \w+)? ([0-9.]+)(?: \w+)? (\w+)",
+                      lines [0])
+        if m is None:
+            return None
+        width, height = int (m.group (1)), int (m.group (2))
+        xres, yres = float (m.group (3)), float (m.group (4))
+        if m.group (5) == b"PixelsPerCentimeter":
+            xres, yres = xres * 2.54, yres * 2.54
+        elif m.group (5) != b"PixelsPerInch" or not xres or not yres:
+            # This is what pdfTeX assumes.
+            xres, yres = 72., 72.
+        if not width or not height:
+            return None
+        return width, height, xres, yres
+
+    def run (self):
+        os.makedirs (os.path.dirname (self.target), exist_ok=True)
+        geometry = self.geometry ()
+        if geometry is not None:
+            width, height, xres, yres = geometry
+            scale = min (1, proxy_pixels / max (width, height))
+            new_width = max (1, round (width * scale))
+            new_height = max (1, round (height * scale))
+            msg.info (_("reducing %s to %dx%d pixels"),
+                      self.source, new_width, new_height)
+            if rubber.util.execute (["convert", self.source + "[0]",
+                    "-resize", "%dx%d!" % (new_width, new_height),
+                    "-units", "PixelsPerInch",
+                    "-density", "%gx%g" % (xres * new_width / width,
+                                           yres * new_height / height),
+                    "-quality", str (proxy_quality),
+                    self.target]) == 0:
+                return True
+        msg.warning (_("cannot reduce %s, using it as is"), self.source)
+        shutil.copyfile (self.source, self.target)
+        return True
+
 class Module (rubber.module_interface.Module):
 
     def __init__ (self, document, opt):
@@ -62,6 +138,8 @@ class Module (rubber.module_interface.Module):
 
         self.prefixes = [os.path.join(x, '') for x in document.env.path]
         self.files = []
+        # The directory of the reduced copies of the draft graphics mode.
+        self.proxies = document.basename (with_suffix="-proxies")
 
         #Latex accepts upper and lowercase filename extensions
         # to keep the above lists clean we auto-generate the
@@ -131,7 +209,7 @@ class Module (rubber.module_interface.Module):
 
         def check (vars):
             source = vars['source']
-            if os.path.exists(vars['target']) and self.doc.env.may_produce(source):
+            if rubber.listing.exists (vars['target']) and self.doc.env.may_produce(source):
                 return False
             if self.suffixes == ['']:
                 return True
@@ -146,7 +224,12 @@ class Module (rubber.module_interface.Module):
 
         if isinstance (node, str):
             msg.debug (_("graphics %s found in %s"), name, node)
-            self.doc.add_source (node)
+            proxy = self.proxy (name, node)
+            if proxy is None:
+                self.doc.add_source (node)
+            else:
+                self.doc.add_source (proxy.target)
+                self.files.append (proxy)
         elif isinstance (node, rubber.depend.Node):
             msg.debug (_("graphics %s converted from %s"),
                        name, node.primary_product ())
@@ -154,7 +237,47 @@ class Module (rubber.module_interface.Module):
             self.files.append(node)
         else:
             assert node is None
-            msg.warning (rubber.util._format (loc, _("graphics `%s' not found") % name))
+            text = _("graphics `%s' not found") % name
+            msg.warning (rubber.util._format (loc, text))
+            self.doc.add_missing (loc, text)
+
+    def proxy (self, name, path):
+        """
+        In draft graphics mode, return a node making a reduced copy of the
+        bitmap at path, which the compiler finds instead when it looks for
+        name. Return None when the original must be included.
+        """
+        if not self.doc.draft_graphics:
+            return None
+        suffix = os.path.splitext (path) [1]
+        if suffix.lower () not in proxy_suffixes:
+            return None
+        # The compiler looks for the name with the suffix it tries.
+        if path.endswith (name + suffix):
+            name = name + suffix
+        elif not path.endswith (name):
+            return None
+        # The copy is found by searching the path of the compiler, which
+        # is not done for absolute or explicitly relative names.
+        parts = name.split ("/")
+        if os.path.isabs (name) or os.curdir in parts or os.pardir in parts:
+            msg.debug (_("graphics %s cannot be replaced in draft mode"), name)
+            return None
+        try:
+            if os.path.getsize (path) < proxy_threshold:
+                return None
+        except OSError:
+            return None
+        if not (prog_available ("convert") and prog_available ("identify")):
+            msg.warning (_("ImageMagick is not available, draft graphics are not reduced"))
+            return None
+        if self.proxies not in self.doc.input_dirs:
+            self.doc.input_dirs.append (self.proxies)
+        target = os.path.join (self.proxies, name)
+        node = self.doc.env.graph.producer.get (target)
+        if node is None:
+            node = Proxy (self.doc.env.graph, path, target)
+        return node
 
     def hook_graphicspath (self, loc, arg):
         # The argument of \graphicspath is a list (in the sense of TeX) of
@@ -186,3 +309,8 @@ class Module (rubber.module_interface.Module):
             assert not node.making
             node.make ()
         return True
+
+    def clean (self):
+        if os.path.isdir (self.proxies):
+            msg.info (_("removing tree %s"), self.proxies)
+            shutil.rmtree (self.proxies, ignore_errors=True)
@@ -1,5 +1,18 @@
+import re
+import rubber.contents
 import rubber.module_interface
 
+# Each bookmark line ends with a serial number in a comment.
+re_serial = re.compile (rb'% *[0-9]+$')
+
+def normalise_out (lines):
+    for line in lines:
+        line = re_serial.sub (b'', line.rstrip ()).rstrip ()
+        if line:
+            yield line + b'\n'
+
+rubber.contents.register ('out', normalise_out, '.out')
+
 class Module (rubber.module_interface.Module):
 
     def __init__ (self, document, opt):
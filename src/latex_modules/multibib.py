@@ -62,8 +62,9 @@ class Module (rubber.module_interface.Module):
                 self.commands [name] = [[cmd, args]]
 
     def hook_newcites (self, loc, name):
-        self.doc.add_product (name + ".aux")
-        bib = self.bibs [name] = rubber.biblio.BibTeXDep (self.doc, name)
+        base = self.doc.output_file (name)
+        self.doc.add_product (base + ".aux")
+        bib = self.bibs [name] = rubber.biblio.BibTeXDep (self.doc, base)
         self.doc.hook_macro('bibliography' + name, 'a',
                             bib.hook_bibliography)
         self.doc.hook_macro('bibliographystyle' + name, 'a',
@@ -0,0 +1,140 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Precompiled preamble support for Rubber.
+
+When this module is loaded, the preamble of the main source (up to
+\\begin{document}, or up to \\endofdump) is dumped into a format with the
+mylatexformat package, and each compilation loads this format instead of
+processing the preamble again. The format is kept between runs of Rubber,
+and dumped again only when the preamble or one of the files it reads
+changes.
+"""
+
+import hashlib
+import logging
+msg = logging.getLogger (__name__)
+import os.path
+import re
+import rubber.contents
+import rubber.module_interface
+import rubber.util
+from rubber.util import _
+
+# The engines whose formats may be dumped by mylatexformat.
+engines = ('TeX', 'pdfTeX', 'XeLaTeX')
+
+re_comment = re.compile (rb'(?<!\\)%')
+re_preamble_end = re.compile (rb'\\begin *\{document\}|\\endofdump(?![a-zA-Z])')
+
+class Module (rubber.module_interface.Module):
+    def __init__ (self, document, opt):
+        self.doc = document
+        self.base = document.basename (with_suffix='-preamble')
+        for suffix in ('.fmt', '.log', '.fls', '.rubberfmt'):
+            document.add_product (self.base + suffix)
+        self.disabled = False
+
+    def pre_compile (self):
+        self.doc.format = None
+        if self.disabled:
+            return True
+        if self.doc.engine not in engines:
+            msg.warning (_("cannot dump a format with %s, compiling normally"),
+                         self.doc.engine)
+            self.disabled = True
+            return True
+        key = self.preamble_key ()
+        if key is None:
+            msg.warning (_("no preamble found in %s"), self.doc.source ())
+            self.disabled = True
+            return True
+        if not self.up_to_date (key):
+            if not self.dump ():
+                msg.warning (_("dumping the preamble failed, compiling normally"))
+                self.disabled = True
+                return True
+            self.record (key)
+        self.doc.format = self.base
+        return True
+
+    def preamble_key (self):
+        """
+        Return a hash of the preamble and of the options of the dump, or
+        None if the main source has no \\begin{document}.
+        """
+        h = hashlib.sha256 ()
+        for word in (self.doc.program, ':'.join (self.doc.env.path),
+                     os.getenv ('TEXINPUTS', ''),
+                     str (self.doc.env.is_in_unsafe_mode_)):
+            h.update (word.encode () + b'\0')
+        with open (self.doc.source (), 'rb') as f:
+            for line in f:
+                code = re_comment.split (line, 1) [0]
+                match = re_preamble_end.search (code)
+                if match is not None:
+                    h.update (line [:match.start ()])
+                    return h.hexdigest ()
+                h.update (line)
+        return None
+
+    def up_to_date (self, key):
+        """
+        Check that the format was dumped from the same preamble, and that
+        the files read by the dump did not change since.
+        """
+        if not os.path.exists (self.base + '.fmt'):
+            return False
+        try:
+            with open (self.base + '.rubberfmt') as f:
+                lines = f.read ().splitlines ()
+        except FileNotFoundError:
+            return False
+        if not lines or lines [0] != key:
+            msg.debug (_("the preamble of %s changed"), self.doc.source ())
+            return False
+        limit = rubber.contents.cs_str_len
+        for line in lines [1:]:
+            path = line [limit + 1:]
+            checksum = rubber.contents.str2cs (line [:limit])
+            if rubber.contents.snapshot (path) != checksum:
+                msg.debug (_("%s changed since the preamble was dumped"), path)
+                return False
+        return True
+
+    def dump (self):
+        msg.info (_("dumping the preamble of %s"), self.doc.source ())
+        cmd = [self.doc.program, '-ini', '-recorder',
+               '-interaction=nonstopmode',
+               '-jobname=' + self.doc.vars ['job'] + '-preamble']
+        cmd.extend (self.doc.output_options ())
+        if self.doc.env.is_in_unsafe_mode_:
+            cmd.append ('--shell-escape')
+        cmd.extend (('&' + self.doc.program, 'mylatexformat.ltx',
+                     self.doc.source ()))
+        return rubber.util.execute (cmd, env=self.doc.texinputs ()) == 0 \
+            and os.path.exists (self.base + '.fmt')
+
+    def record (self, key):
+        """
+        Write the key of the format with the checksums of the files that
+        the dump read, as listed by the -recorder option.
+        """
+        source = os.path.normpath (self.doc.source ())
+        outputs = set (os.path.normpath (self.base + suffix)
+                       for suffix in ('.fmt', '.log', '.fls'))
+        inputs = []
+        with open (self.base + '.fls', errors='replace') as f:
+            for line in f:
+                if not line.startswith ('INPUT '):
+                    continue
+                path = line [6:].rstrip ('\n')
+                normal = os.path.normpath (path)
+                if normal != source and normal not in outputs \
+                   and path not in inputs:
+                    inputs.append (path)
+        with open (self.base + '.rubberfmt', 'w') as f:
+            f.write (key + '\n')
+            for path in inputs:
+                f.write (rubber.contents.cs2str (rubber.contents.snapshot (path)))
+                f.write (' ' + path + '\n')
@@ -18,7 +18,7 @@ class Module (rubber.module_interface.Module):
         if not ps.endswith ('.ps'):
             raise rubber.GenericError (_("ps2pdf cannot produce PS"))
         pdf = ps[:-2] + 'pdf'
-        dep = Shell (('ps2pdf', ps, pdf))
+        dep = Shell (document.env.graph, ('ps2pdf', ps, pdf))
         dep.add_product (pdf)
         dep.add_source (ps)
         document.env.final = dep
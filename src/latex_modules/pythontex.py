@@ -18,7 +18,7 @@ class PythonTeXDep (rubber.depend.Shell):
     def __init__ (self, document):
         self.doc = document
         basename = self.doc.basename ()
-        super ().__init__ (('pythontex', basename))
+        super ().__init__ (document.env.graph, ('pythontex', basename))
         self.pythontex_files = 'pythontex-files-' + basename
 
         pytxcode = basename + '.pytxcode'
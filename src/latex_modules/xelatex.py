@@ -6,3 +6,5 @@ class Module (rubber.module_interface.Module):
         document.program = 'xelatex'
         document.engine = 'XeLaTeX'
         document.register_post_processor (old_suffix='.pdf', new_suffix='.pdf')
+        # Written instead of the PDF by the draft compilations.
+        document.add_product (document.basename (with_suffix='.xdv'))
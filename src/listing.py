@@ -0,0 +1,101 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Existence of files, answered from directory listings.
+
+Looking for a source means trying many names (with various prefixes and
+suffixes) in many directories, and most of these attempts fail. Instead
+of asking the operating system about each name, each directory is listed
+once with os.scandir, and the queries about the files it contains, found
+or missing, are answered from memory.
+
+The listings are only valid while nothing writes in the directories.
+Rubber itself calls invalidate after running external programs and
+recipes, which are the only ways it creates files during a build.
+"""
+
+import logging
+msg = logging.getLogger (__name__)
+import os
+import threading
+
+# The kinds of directory entries.
+MISSING, FILE, OTHER = range (3)
+
+# directory -> (name -> kind, lowercased names), or None when the
+# operating system must be asked about each name.
+_listings = {}
+# Incremented by invalidate, so that a listing made meanwhile is dropped.
+_generation = 0
+_lock = threading.Lock ()
+
+def invalidate ():
+    """Forget all listings, since files may have been created or removed."""
+    global _generation
+    with _lock:
+        _listings.clear ()
+        _generation += 1
+
+def _kind (entry):
+    try:
+        if entry.is_file ():
+            return FILE
+        if entry.is_symlink () and not os.path.exists (entry.path):
+            # A broken link.
+            return MISSING
+    except OSError:
+        return MISSING
+    return OTHER
+
+def _listing (directory):
+    with _lock:
+        if directory in _listings:
+            return _listings [directory]
+        generation = _generation
+    try:
+        kinds = {}
+        with os.scandir (directory) as entries:
+            for entry in entries:
+                kinds [entry.name] = _kind (entry)
+        listing = kinds, set (name.lower () for name in kinds)
+        msg.debug ('listed %d entries in %s', len (kinds), directory)
+    except (FileNotFoundError, NotADirectoryError):
+        listing = {}, set ()
+    except OSError:
+        # For instance, a directory that may be traversed but not read.
+        listing = None
+    with _lock:
+        if generation == _generation:
+            _listings [directory] = listing
+    return listing
+
+def _lookup (path):
+    """
+    The kind of the entry at path, or None when the listing cannot tell.
+    """
+    directory, name = os.path.split (path)
+    if name in ('', os.curdir, os.pardir):
+        return None
+    listing = _listing (directory or os.curdir)
+    if listing is None:
+        return None
+    kinds, folded = listing
+    kind = kinds.get (name, MISSING)
+    if kind == MISSING and name.lower () in folded:
+        # The file system may ignore the case of names.
+        return None
+    return kind
+
+def exists (path):
+    """Like os.path.exists."""
+    kind = _lookup (path)
+    if kind is None:
+        return os.path.exists (path)
+    return kind != MISSING
+
+def isfile (path):
+    """Like os.path.isfile."""
+    kind = _lookup (path)
+    if kind is None:
+        return os.path.isfile (path)
+    return kind == FILE
@@ -99,12 +99,28 @@ class Token:
     The class used to represent tokens. Objects contain a catcode, a value
     (for control sequences) and the raw text that represents them in the input
     file.
+
+    Parsers may give the position as a pair (line, char), the Position object
+    is only built when the attribute 'pos' is read.
     """
+    __slots__ = ('cat', 'val', 'raw', '_pos')
+
     def __init__ (self, cat, val=None, raw=None, pos=None):
         self.cat = cat
         self.val = val
         self.raw = raw
-        self.pos = pos
+        self._pos = pos
+
+    @property
+    def pos (self):
+        pos = self._pos
+        if type (pos) is tuple:
+            pos = self._pos = Position (line=pos[0], char=pos[1])
+        return pos
+
+    @pos.setter
+    def pos (self, pos):
+        self._pos = pos
 
     def __repr__ (self):
         text = 'Token(' + cat_names[self.cat]
@@ -157,6 +173,16 @@ class ParserBase (object):
         else:
             return OTHER
 
+    def read_text (self):
+        """
+        Read as many characters as possible that need no special treatment
+        in a group (no braces, math shifts, escapes, comments or end of
+        lines) and return them as a string. Derived classes that can do this
+        faster than reading tokens one by one override this method, the
+        default returns an empty string.
+        """
+        return ""
+
     def put_token (self, token):
         """
         Put back a token in the input.
@@ -190,12 +216,11 @@ class ParserBase (object):
         else:
             token = self.read_token()
 
-        # skip over comment
-        if token.cat == COMMENT:
+        # skip over comments
+        while token.cat == COMMENT:
             assert len(self.next) == 0
-            assert self.next_char is None
-            self.read_line()
-            return self.read_token()
+            self.skip_comment()
+            token = self.read_token()
 
         if token.cat == MATH:
             if self.last_is_math:
@@ -259,6 +284,11 @@ class ParserBase (object):
         value = ""
         level = 1
         while 1:
+            if len(self.next) == 0:
+                text = self.read_text()
+                if text:
+                    value += text
+                    self.last_is_math = 0
             token = self.get_token()
             if token.cat == OPEN:
                 level += 1
@@ -375,16 +405,37 @@ def re_set (set, complement=False):
             expr += c
     return expr + ']'
 
+# Compiled regular expressions for the catcode tables in use, indexed by the
+# set of their entries, and for the sets of hooks, indexed by the set of
+# names, the catcode table and the comment line expression.
+
+_tables = {}
+_hooks = {}
+
 class Parser (ParserBase):
     """
     A parser for TeX code that reads its input from a file object.
 
+    The whole input is read at once and never copied afterwards: the parser
+    keeps the index of the next character to read in the attribute 'col'.
+    Control sequence names and runs of plain text are read at once with
+    regular expressions compiled for the catcode table, so
+    'compile_catcodes' must be called after changing the attribute
+    'catcodes'.
+
     The class also provides a hook feature: the method 'set_hooks' declares a
     set of control sequence names, and the method 'next_hook' parses the input
     until it finds a control sequence from this set, ignoring all other
     tokens. This advantage of this method is that is is much faster than
     reading tokens one by one.
+
+    Comment lines (comments with nothing but spaces before them) that match
+    the class attribute 're_comment_line' are not ignored: the match is passed
+    to the method 'comment_line', both when reading tokens and when looking
+    for hooks.
     """
+    re_comment_line = None
+
     def __init__ (self, input):
         """
         Initialise the parser with a file as input.
@@ -392,48 +443,101 @@ class Parser (ParserBase):
         the 'put_token' and 'put_list' methods.
         """
         super (Parser, self).__init__()
-        self.input = input
-        self.line = ""
+        if input is None:
+            self.text = ""
+        else:
+            self.text = input.read()
+        self.col = 0
+        self.line_start = 0
         self.pos_line = 1
-        self.pos_char = 1
-        self.next_char = None
+        self.compile_catcodes()
 
-    def read_line (self):
+    @property
+    def pos_char (self):
         """
-        Reads a line of input and sets the attribute 'line' with it. Returns
-        True if reading succeeded and False if it failed.
+        The column of the next character to read, starting from 1.
         """
-        if self.input is None:
-            return False
-        self.line = self.input.readline()
-        if self.line == "":
-            return False
-        return True
+        return self.col - self.line_start + 1
+
+    def compile_catcodes (self):
+        """
+        Prepare the regular expressions used for reading names and text
+        runs with the current catcode table.
+        """
+        self.catcodes_key = frozenset(self.catcodes.items())
+        tables = _tables.get(self.catcodes_key)
+        if tables is None:
+            name = re.compile('(?P<name>' + self.re_cat(LETTER) + '+)' \
+                + self.re_cat(SPACE) + '*')
+            text = re.compile(self.re_nocat(ESCAPE, OPEN, CLOSE, MATH,
+                END_LINE, COMMENT) + '*')
+            tables = _tables[self.catcodes_key] = (name, text)
+        self.re_name, self.re_text = tables
+
+    def move (self, col):
+        """
+        Move forward to the given index in the input, keeping track of the
+        line number.
+        """
+        lines = self.text.count('\n', self.col, col)
+        if lines:
+            self.pos_line += lines
+            self.line_start = self.text.rfind('\n', self.col, col) + 1
+        self.col = col
+
+    def skip_line (self):
+        """
+        Ignore the rest of the current line, including the end of line.
+        """
+        end = self.text.find('\n', self.col)
+        if end < 0:
+            self.move(len(self.text))
+        else:
+            self.move(end + 1)
+
+    def skip_comment (self):
+        """
+        Ignore the rest of the line after a comment character, passing it to
+        'comment_line' first if relevant.
+        """
+        start = self.col - 1
+        if self.re_comment_line is not None \
+           and self.text[self.line_start:start].strip() == "":
+            match = self.re_comment_line.match(self.text, start)
+            if match is not None:
+                self.comment_line(match)
+        self.skip_line()
+
+    def comment_line (self, match):
+        """
+        Handle a comment line matching 're_comment_line'. The attribute
+        'pos_line' is the line number of the comment. Derived classes that set
+        're_comment_line' override this method.
+        """
+        pass
 
     def read_char (self):
         """
         Get the next character from the input and its catcode (without parsing
         control sequences).
         """
-        if self.next_char is not None:
-            t = self.next_char
-            self.next_char = None
-            return t
+        col = self.col
+        if col >= len(self.text):
+            return Token(EOF)
+        c = self.text[col]
+        self.col = col + 1
 
-        while self.line == "":
-            if not self.read_line():
-                return Token(EOF)
-        c = self.line[0]
-        self.line = self.line[1:]
-
-        pos = Position(line=self.pos_line, char=self.pos_char)
+        pos = (self.pos_line, col - self.line_start + 1)
         if c == '\n':
             self.pos_line += 1
-            self.pos_char = 1
-        else:
-            self.pos_char += 1
+            self.line_start = col + 1
 
-        return Token(self.catcode(c), raw=c, pos=pos)
+        return Token(self.catcodes.get(c, OTHER), raw=c, pos=pos)
+
+    def read_text (self):
+        match = self.re_text.match(self.text, self.col)
+        self.col = match.end()
+        return match.group()
 
     def read_token (self):
         """
@@ -444,24 +548,21 @@ class Parser (ParserBase):
             if token.cat in (LETTER, OTHER):
                 token.val = token.raw
             return token
-        pos = token.pos
-        raw = token.raw
-        token = self.read_char()
-        if token.cat != LETTER:
+        match = self.re_name.match(self.text, self.col)
+        if match is None:
+            raw = token.raw
+            token = self.read_char()
+            if token.cat == EOF:
+                return Token(CSEQ, '', raw)
             token.cat = CSEQ
             token.val = token.raw
             token.raw = raw + token.raw
             return token
-        name = ""
-        while token.cat == LETTER:
-            raw += token.raw
-            name += token.raw
-            token = self.read_char()
-        while token.cat == SPACE:
-            raw += token.raw
-            token = self.read_char()
-        self.next_char = token
-        return Token(CSEQ, name, raw, pos=pos)
+        self.col = match.end()
+        token.cat = CSEQ
+        token.val = match.group('name')
+        token.raw += match.group()
+        return token
 
     def re_cat (self, *cat):
         """
@@ -480,34 +581,60 @@ class Parser (ParserBase):
     def set_hooks (self, names):
         """
         Define the set of hooks for 'next_hook'.
-        """
-        expr = '(' \
-            + self.re_nocat(ESCAPE, COMMENT) + '|' \
-            + self.re_cat(ESCAPE) + self.re_cat(ESCAPE, COMMENT) + ')*' \
-            + '(?P<raw>' + self.re_cat(ESCAPE) \
-            + '(?P<val>' + '|'.join(names) + ')' \
-            + '(' + self.re_cat(SPACE) + '+|(?=' + self.re_nocat(LETTER) + ')|$))'
-        self.regex = re.compile(expr)
+
+        The expression scans the input for comment lines, other comments,
+        hooks and other control sequences, in this order of priority. Only
+        comment lines and hooks have named groups.
+        """
+        comment_line = self.re_comment_line
+        if comment_line is not None:
+            comment_line = comment_line.pattern
+        key = (frozenset(names), self.catcodes_key, comment_line)
+        regex = _hooks.get(key)
+        if regex is None:
+            if names:
+                names = '|'.join(map(re.escape, sorted(names)))
+            else:
+                names = '(?!)'
+            expr = ''
+            if comment_line is not None:
+                expr += '^[^\\S\\n]*(?P<comment_line>' + comment_line + ')|'
+            expr += self.re_cat(COMMENT) + '[^\\n]*' \
+                + '|(?P<raw>' + self.re_cat(ESCAPE) \
+                + '(?P<val>' + names + ')' \
+                + '(' + self.re_cat(SPACE) + '+|(?!' + self.re_cat(LETTER) + ')))' \
+                + '|' + self.re_cat(ESCAPE) \
+                + '(' + self.re_cat(LETTER) + '+|[\\s\\S])'
+            regex = _hooks[key] = re.compile(expr, re.MULTILINE)
+        self.regex = regex
 
     def next_hook (self):
         """
         Ignore input until the next control sequence from the set defined by
         'set_hooks'. Returns the associated token, or the EOF token if no hook
-        was found.
+        was found. The hooks may be redefined by 'comment_line', the search
+        then goes on with the new ones.
         """
-        while self.line == "":
-            if not self.read_line():
-                return Token(EOF)
         while True:
-            match = self.regex.match(self.line)
-            if match is not None:
-                self.pos_char = match.end('raw') + 1
-                self.line = self.line[match.end('raw'):]
-                return Token(CSEQ, match.group('val'), match.group('raw'))
-            if not self.read_line():
+            regex = self.regex
+            for match in regex.finditer(self.text, self.col):
+                kind = match.lastgroup
+                if kind is None:
+                    continue
+                self.move(match.start())
+                if kind == 'raw':
+                    pos = (self.pos_line, self.pos_char)
+                    self.col = match.end()
+                    return Token(CSEQ, match.group('val'), match.group('raw'),
+                                 pos=pos)
+                self.move(match.start(kind))
+                self.comment_line(self.re_comment_line.match(self.text, self.col))
+                self.skip_line()
+                if self.regex is not regex:
+                    break
+            else:
+                self.move(len(self.text))
                 return Token(EOF)
-            self.pos_line += 1
-            self.pos_char = 1
 
 def parse_string (text):
     """
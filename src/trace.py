@@ -0,0 +1,76 @@
+# This file is part of Rubber and thus covered by the GPL
+# vim: noet:ts=4
+"""
+Build timeline in the Chrome trace-event format.
+
+When enabled (see the --trace option), each recipe run and each
+external process is recorded with its duration and some details, and
+the result may be opened with chrome://tracing or Perfetto.
+Recording is disabled by default and costs nothing then.
+"""
+
+import contextlib
+import json
+import os
+import threading
+import time
+
+# The list of recorded events, or None when tracing is disabled.
+_events = None
+_origin = 0
+_lock = threading.Lock ()
+# The arguments of the spans open in each thread.
+_stack = threading.local ()
+
+def enable ():
+    global _events, _origin
+    _events = []
+    _origin = time.perf_counter ()
+
+def enabled ():
+    return _events is not None
+
+def _now ():
+    return int ((time.perf_counter () - _origin) * 1000000)
+
+@contextlib.contextmanager
+def span (name, category, **args):
+    """
+    Record the duration of a with statement. The keyword arguments are
+    shown as details of the event. The argv argument of a span opened
+    inside another one is also listed in the 'commands' detail of the
+    enclosing span.
+    """
+    if _events is None:
+        yield
+        return
+    opened = getattr (_stack, 'spans', None)
+    if opened is None:
+        opened = _stack.spans = []
+    if opened and 'argv' in args:
+        opened [-1].setdefault ('commands', []).append (' '.join (args ['argv']))
+    opened.append (args)
+    start = _now ()
+    try:
+        yield
+    finally:
+        end = _now ()
+        opened.pop ()
+        event = {
+            'name': name,
+            'cat': category,
+            'ph': 'X',
+            'ts': start,
+            'dur': end - start,
+            'pid': os.getpid (),
+            'tid': threading.get_ident (),
+            'args': args,
+        }
+        with _lock:
+            _events.append (event)
+
+def save (path):
+    """Write the events recorded so far."""
+    with open (path, 'w') as f:
+        json.dump ({'traceEvents': _events, 'displayTimeUnit': 'ms'}, f,
+                   indent=0)
@@ -6,8 +6,10 @@ This module contains utility functions and classes used by the main system and
 by the modules for various tasks.
 """
 
+import contextlib
 import os.path, stat
 import errno
+import getpass
 import imp
 import logging
 msg = logging.getLogger (__name__)
@@ -15,6 +17,9 @@ import re
 from string import whitespace
 import subprocess
 import sys
+import tempfile
+import rubber.listing
+import rubber.trace
 
 #-- Message writers --{{{1
 
@@ -123,6 +128,46 @@ def prog_available (prog):
     checked_progs[prog] = None
     return None
 
+#-- Locking files --{{{1
+
+try:
+    import fcntl
+except ImportError:
+    # Without fcntl (Windows), concurrent runs are not detected.
+    fcntl = None
+
+@contextlib.contextmanager
+def lock_file (path):
+    """
+    Hold an exclusive lock on the given file, creating it if needed,
+    for the duration of a with statement. Other processes attempting
+    to lock the same file wait until the lock is released.
+    The file only serves as a lock, and must not be replaced while it is
+    held, since new processes would lock the new file at once. Lock a
+    sibling such as FILE.lock to protect a file that is replaced. If the
+    lock file is removed, the processes waiting for it lock a new one.
+    """
+    if fcntl is None:
+        yield
+        return
+    while True:
+        f = open (path, 'a')
+        try:
+            fcntl.flock (f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except BlockingIOError:
+            msg.info (_("waiting for another process to release %s"), path)
+            fcntl.flock (f, fcntl.LOCK_EX)
+        try:
+            same = os.fstat (f.fileno ()).st_ino == os.stat (path).st_ino
+        except FileNotFoundError:
+            same = False
+        if same:
+            break
+        # The file has been replaced or removed while we were waiting.
+        f.close ()
+    with f:
+        yield
+
 #-- Parsing commands --{{{1
 
 re_variable = re.compile("(?P<name>[a-zA-Z]+)")
@@ -236,6 +281,43 @@ def explode_path (name = "PATH"):
     else:
         return []
 
+def cache_directory ():
+    """
+    The directory where rubber keeps data shared by all documents.
+    """
+    base = os.getenv ('XDG_CACHE_HOME') \
+        or os.path.join (os.path.expanduser ('~'), '.cache')
+    return os.path.join (base, 'rubber')
+
+def tmpfs_directory ():
+    """
+    A directory private to the user, on a file system kept in memory
+    when one is available, for the intermediate files of builds. It is
+    created if needed. If another user owns it, or may write in it, a
+    new temporary directory is used instead.
+    """
+    for base in (os.getenv ('XDG_RUNTIME_DIR'), '/dev/shm'):
+        if base and os.path.isdir (base) and os.access (base, os.W_OK):
+            break
+    else:
+        base = tempfile.gettempdir ()
+    path = os.path.join (base, 'rubber-' + getpass.getuser ())
+    try:
+        os.makedirs (path, mode=0o700, exist_ok=True)
+        st = os.lstat (path)
+    except OSError as e:
+        msg.debug (_("cannot create %s: %s"), path, e)
+    else:
+        # Another user may have created the directory first.
+        if not hasattr (os, 'getuid'):
+            return path
+        if stat.S_ISDIR (st.st_mode) and st.st_uid == os.getuid () \
+           and stat.S_IMODE (st.st_mode) == 0o700:
+            return path
+        msg.warning (_("not using %s, which is not a private directory"),
+                     path)
+    return tempfile.mkdtemp (prefix='rubber-')
+
 def find_resource (name, suffix = "", paths = []):
     """
     find the indicated file, mimicking what latex would do:
@@ -244,16 +326,16 @@ def find_resource (name, suffix = "", paths = []):
     """
     name = name.strip ()
 
-    if os.path.exists (name):
+    if rubber.listing.exists (name):
         return name
-    elif suffix != "" and os.path.exists (name + suffix):
+    elif suffix != "" and rubber.listing.exists (name + suffix):
         return name + suffix
 
     for path in paths:
         fullname = os.path.join (path, name)
-        if os.path.exists (fullname):
+        if rubber.listing.exists (fullname):
             return fullname
-        elif suffix != "" and os.path.exists (fullname + suffix):
+        elif suffix != "" and rubber.listing.exists (fullname + suffix):
             return fullname + suffix
 
     return None
@@ -264,7 +346,8 @@ def execute (prog, env={}, pwd=None, out=None):
     of arguments for the program, `prog[0]' is the program name. The `env'
     argument is a dictionary with definitions that should be added to the
     environment when running the program. The standard output is passed
-    line by line to the `out' function (or discarded by default).
+    line by line to the `out' function (or discarded by default). When
+    this function returns a true value, the program is killed.
     """
     msg.info(_("executing: %s") % " ".join (prog))
     if pwd:
@@ -281,20 +364,27 @@ def execute (prog, env={}, pwd=None, out=None):
     for (key,val) in env.items():
         penv[key] = val
 
-    process = subprocess.Popen(prog,
-        executable = progname,
-        env = penv,
-        cwd = pwd,
-        stdin = subprocess.DEVNULL,
-        stdout = subprocess.PIPE,
-        stderr = None)
-
-    if out is not None:
-        for line in process.stdout:
-            out(line)
-    else:
-        process.stdout.readlines()
+    with rubber.trace.span (prog [0], 'process', argv=list (prog)):
+        process = subprocess.Popen(prog,
+            executable = progname,
+            env = penv,
+            cwd = pwd,
+            stdin = subprocess.DEVNULL,
+            stdout = subprocess.PIPE,
+            stderr = None)
+
+        if out is not None:
+            for line in process.stdout:
+                if out(line):
+                    msg.debug(_("stopping process %d (%s)") % (process.pid, prog[0]))
+                    process.kill()
+                    break
+        else:
+            process.stdout.readlines()
+        process.stdout.close()
 
-    ret = process.wait()
+        ret = process.wait()
+    # The program may have written files.
+    rubber.listing.invalidate ()
     msg.debug(_("process %d (%s) returned %d") % (process.pid, prog[0], ret))
     return ret
@@ -1,6 +1,8 @@
 # vim: noet:ts=4
 from rubber.tex import *
+import re
 import unittest
+from io import StringIO
 
 class TestTexParser(unittest.TestCase):
 
@@ -60,5 +62,45 @@ class TestMacroWithLatexOptional(TestTexParser):
 	def test_latexmacro5(self):
 		self.run_it("\\usepackage[aloha1,aloha2=aloha3]\n{aloha4}")
 
+class CommentLineParser(Parser):
+	re_comment_line = re.compile(r"% *rubber: *(?P<cmd>[^\n]*)")
+
+	def __init__(self, text):
+		super().__init__(StringIO(text))
+		self.directives = []
+
+	def comment_line(self, match):
+		self.directives.append((match.group("cmd"), self.pos_line))
+
+class TestHooks(unittest.TestCase):
+	def hooks(self, text, names):
+		self.p = CommentLineParser(text)
+		self.p.set_hooks(names)
+		found = []
+		while True:
+			t = self.p.next_hook()
+			if t.cat == EOF:
+				return found
+			found.append((t.val, t.pos.line, t.pos.char, self.p.get_argument_text()))
+
+	def test_after_other_macro(self):
+		self.assertEqual(self.hooks("\\emph{x}\\input{a}\n", ["input"]),
+			[("input", 1, 9, "a")])
+
+	def test_escaped(self):
+		self.assertEqual(self.hooks("\\\\input{a}\\%\\inputx{b}\n\\input {c}", ["input"]),
+			[("input", 2, 1, "c")])
+
+	def test_comments(self):
+		text = "%\\input{a}\n % rubber: one\nx % rubber: two\n\\input{b}\n"
+		self.assertEqual(self.hooks(text, ["input"]), [("input", 4, 1, "b")])
+		self.assertEqual(self.p.directives, [("one", 2)])
+
+	def test_tokens(self):
+		self.p = CommentLineParser("\\foo%\n% rubber: one\n%\n{a}")
+		self.assertEqual(self.p.get_token().val, "foo")
+		self.assertEqual(self.p.get_argument_text(), "a")
+		self.assertEqual(self.p.directives, [("one", 2)])
+
 if __name__ == '__main__':
 	unittest.main()
@@ -30,7 +30,8 @@ while [ 1 -le $# ]; do
                 python3-prompt-toolkit python3-pygments r-cran-knitr \
                 texlive-bibtex-extra texlive-binaries texlive-extra-utils \
                 texlive-latex-extra texlive-latex-recommended \
-                texlive-metapost texlive-omega texlive-pictures transfig
+                texlive-metapost texlive-omega texlive-pictures transfig \
+                inkscape
             # combine is not packaged for Debian.
             touch combine/disable
             ;;